@@ -10,17 +10,35 @@ Original file is located at
 import argparse
 
 # Imports for Data Processing
-import glob
 import pickle
+import shutil
+import sys
+import tempfile
 
 import numpy as np
-import pandas as pd
-from datasets import ClassLabel, Dataset, DatasetDict
+from datasets import ClassLabel, Dataset
 
 PROJECT_DIR = "/cluster/project2/COMP0029_17022125/NLP-FYP-HPC/"
 SCRATCH_SPACE = "/home/sejipark/NLP-FYP-HPC/"
 SEED = 2023
 
+sys.path.append(PROJECT_DIR)
+
+from shared.corpus_loader import load_corpus
+from shared.dataset_views import (
+    build_key,
+    full_dataset_labels,
+    load_full_dataset,
+    save_full_dataset,
+    save_index_view,
+)
+from shared.ingest import ingest_corpus
+from shared.pair_tables import PAIR_FEATURES, PairRows, PairTableBuilder
+from shared.parallel import build_shards
+from shared.rank_shards import save_rank_shards
+from shared.relation_matrix import RelationMatrix
+from shared.shard_cache import ShardCache
+
 parser = argparse.ArgumentParser()
 parser.add_argument(
     "--t", type=str, help="Recipe Corpus Target: can either be r-100, r-200, or r-300"
@@ -28,75 +46,43 @@ parser.add_argument(
 parser.add_argument(
     "--us", type=float, help="Undersample Factor: value between 0.0 and 1.0"
 )
+parser.add_argument(
+    "--workers",
+    type=int,
+    default=1,
+    help="Number of Worker Processes Constructing Recipes in Parallel",
+)
+parser.add_argument(
+    "--shards",
+    type=int,
+    default=1,
+    help="Number of Label-Stratified Rank Shards Written per Split",
+)
 
 args = parser.parse_args()
 
 TARGET_CORPUS = args.t
 UNDERSAMPLE_FACTOR = args.us
+WORKERS = args.workers
+SHARDS = args.shards
 
 GLOBAL_INCLUDED_COUNT, GLOBAL_REJECTED_COUNT, GLOBAL_EDGE_COUNT = 0, 0, 0
+PAIR_TABLE = PairTableBuilder()
 
-NER_FILES, FLOW_FILES = [], []
-
-if TARGET_CORPUS == "r-100" or TARGET_CORPUS == "r-200":
-    NER_FILES += glob.glob(PROJECT_DIR + TARGET_CORPUS + "/*.list")
-    FLOW_FILES += glob.glob(PROJECT_DIR + TARGET_CORPUS + "/*.flow")
-elif TARGET_CORPUS == "r-300":
-    for corpus in ["r-100", "r-200"]:
-        NER_FILES += glob.glob(PROJECT_DIR + corpus + "/*.list")
-        FLOW_FILES += glob.glob(PROJECT_DIR + corpus + "/*.flow")
-else:
-    raise Exception("Could not recognize target corpus")
-
-NER_FILES.sort()
-FLOW_FILES.sort()
-
-
-def encode_key(decoded_key):
-    if len(decoded_key) != 3:
-        raise Exception("Malformed Key During Encoding: Length != 3")
-
-    return str(decoded_key[0]) + ";" + str(decoded_key[1]) + ";" + str(decoded_key[2])
-
-
-def decode_key(encoded_key):
-    encoded_key = encoded_key.split(";")
-
-    if len(encoded_key) != 3:
-        raise Exception("Malformed Key During Decoding: Length != 3")
-    return (int(encoded_key[0]), int(encoded_key[1]), int(encoded_key[2]))
-
-
-def construct_recipe_dict(ner_lines, remove_iob=False):
-    word_dict = {}
-    ner_dict = {}
-
-    for line in ner_lines:
-        items = line.strip().split(" ")
-
-        key, word, ner_tag = encode_key(items[:3]), items[3], items[5]
-
-        if remove_iob:
-            ner_tag = ner_tag.replace("-B", "").replace("-B", "")
-
-        word_dict[key] = word
-        ner_dict[key] = ner_tag
-
-    return word_dict, ner_dict
+CORPUS = load_corpus(PROJECT_DIR, TARGET_CORPUS)
+RECIPES, RELATION_SET = ingest_corpus(CORPUS)
+SHARD_CACHE = ShardCache(
+    PROJECT_DIR, TARGET_CORPUS, "directional-label", CORPUS, RELATION_SET
+)
 
 
-def construct_label_dict(flow_lines):
+def construct_label_dict(recipe):
     global GLOBAL_EDGE_COUNT
     recipe_dict = {}
 
-    for line in flow_lines:
+    for source_node, label, dest_node in recipe.flows:
         GLOBAL_EDGE_COUNT += 1
-        items = line.strip().split(" ")
-
-        source_node = (int(items[0]), int(items[1]), int(items[2]))
-        dest_node = (int(items[4]), int(items[5]), int(items[6]))
 
-        label = items[3]
         if label == "v":
             label = "v-tm"
         elif label == "s":
@@ -112,182 +98,154 @@ def construct_label_dict(flow_lines):
     return recipe_dict
 
 
-RELATION_SET = set()
-
-for ner_file, flow_file in zip(NER_FILES, FLOW_FILES):
-    ner_data, flow_data = open(ner_file, "r", encoding="utf-8"), open(
-        flow_file, "r", encoding="utf-8"
-    )
-    ner_lines, flow_lines = ner_data.readlines(), flow_data.readlines()
-
-    _, ner_dict = construct_recipe_dict(ner_lines)
-
-    for line in flow_lines:
-        items = line.strip().split(" ")
-        source_key, dest_key = encode_key(items[:3]), encode_key(items[4:])
-
-        relation = ner_dict[source_key] + "->" + ner_dict[dest_key]
-
-        RELATION_SET.add(relation)
-
-    ner_data.close()
-    flow_data.close()
-
 with open(
     PROJECT_DIR + TARGET_CORPUS + "-relation_set.pickle", "wb"
 ) as relation_set_file:
     pickle.dump(RELATION_SET, relation_set_file)
 
+RELATION_MATRIX = RelationMatrix.from_relation_set(RELATION_SET)
+RELATION_MATRIX.save(PROJECT_DIR + TARGET_CORPUS + "-relation_matrix.npz")
 
-def generate_pairs(ner_lines, ner_dict):
+
+def generate_pairs(recipe):
     global GLOBAL_INCLUDED_COUNT
     global GLOBAL_REJECTED_COUNT
 
-    positions, pairs = [], []
-
-    for line in ner_lines:
-        items = line.split(" ")
-        label = items[5].replace("\n", "")
+    positions, ner_tags = [], []
 
+    for key, _, _, label in recipe.tokens:
         if "-I" not in label and label != "O":
-            position = (int(items[0]), int(items[1]), int(items[2]))
-            positions.append(position)
+            positions.append(key)
+            ner_tags.append(label)
 
-    for i in range(len(positions)):
-        for j in range(i + 1, len(positions)):
-            source_key, dest_key = encode_key(positions[i]), encode_key(positions[j])
-            source_ner, dest_ner = ner_dict[source_key], ner_dict[dest_key]
+    sources, dests, num_rejected = RELATION_MATRIX.candidate_pairs(ner_tags)
 
-            flow1 = source_ner + "->" + dest_ner
-            flow2 = dest_ner + "->" + source_ner
+    GLOBAL_INCLUDED_COUNT += len(sources)
+    GLOBAL_REJECTED_COUNT += num_rejected
 
-            if flow1 in RELATION_SET or flow2 in RELATION_SET:
-                pairs.append((positions[i], positions[j]))
-                GLOBAL_INCLUDED_COUNT += 1
-            else:
-                GLOBAL_REJECTED_COUNT += 1
+    return [
+        (positions[source], positions[dest])
+        for source, dest in zip(sources.tolist(), dests.tolist())
+    ]
 
-    return pairs
 
+def construct_recipe_data(recipe):
+    pair_rows = PairRows(recipe)
+    label_dict = construct_label_dict(recipe)
 
-def construct_sentence(ner_lines, position):
-    first_word = True
-    sentence = ""
+    for word_pair_position in generate_pairs(recipe):
+        if (word_pair_position[0], word_pair_position[1]) in label_dict:
+            pair_rows.append(
+                *word_pair_position,
+                label_dict[(word_pair_position[0], word_pair_position[1])],
+            )
+        else:
+            pair_rows.append(*word_pair_position, "non-edge")
 
-    for line in ner_lines:
-        items = line.split(" ")
-        items[0], items[1], items[2] = int(items[0]), int(items[1]), int(items[2])
+    return pair_rows.shard()
 
-        if (position[0], position[1]) == (items[0], items[1]):
-            if not first_word:
-                sentence += " "
 
-            first_word = False
+def construct_shard(recipe_index):
+    # Counters are accumulated per recipe and summed by the parent process,
+    # since worker processes cannot update the parent's globals
+    global GLOBAL_INCLUDED_COUNT, GLOBAL_REJECTED_COUNT, GLOBAL_EDGE_COUNT
+    GLOBAL_INCLUDED_COUNT, GLOBAL_REJECTED_COUNT, GLOBAL_EDGE_COUNT = 0, 0, 0
 
-            sentence += items[3]
+    rows = construct_recipe_data(RECIPES[recipe_index])
 
-    return sentence
+    return rows, (GLOBAL_INCLUDED_COUNT, GLOBAL_REJECTED_COUNT, GLOBAL_EDGE_COUNT)
 
 
 def construct_data():
-    word_pairs, sentence_pairs, labels = [], [], []
-
-    for ner_file, flow_file in zip(NER_FILES, FLOW_FILES):
-        ner_data, flow_data = open(ner_file, "r", encoding="utf-8"), open(
-            flow_file, "r", encoding="utf-8"
-        )
-
-        ner_lines, flow_lines = ner_data.readlines(), flow_data.readlines()
-
-        word_dict, ner_dict = construct_recipe_dict(ner_lines)
-        label_dict = construct_label_dict(flow_lines)
+    global GLOBAL_INCLUDED_COUNT, GLOBAL_REJECTED_COUNT, GLOBAL_EDGE_COUNT
 
-        if word_dict.keys() != ner_dict.keys():
-            raise Exception("Malformed Word and NER Dictionary")
+    counts = [0, 0, 0]
 
-        word_pair_positions = generate_pairs(ner_lines, ner_dict)
+    for shard, shard_counts in build_shards(
+        construct_shard, len(RECIPES), WORKERS, SHARD_CACHE
+    ):
+        yield from PAIR_TABLE.add_shard(shard)
 
-        for word_pair_position in word_pair_positions:
-            word1_key = encode_key(word_pair_position[0])
-            word2_key = encode_key(word_pair_position[1])
+        counts = [
+            count + shard_count for count, shard_count in zip(counts, shard_counts)
+        ]
 
-            if word_pair_position[0] < word_pair_position[1]:
-                word_pairs.append(word_dict[word1_key] + " " + word_dict[word2_key])
-            else:
-                word_pairs.append(word_dict[word2_key] + " " + word_dict[word1_key])
+    GLOBAL_INCLUDED_COUNT, GLOBAL_REJECTED_COUNT, GLOBAL_EDGE_COUNT = counts
 
-            sentence1 = construct_sentence(ner_lines, position=word_pair_position[0])
-            sentence2 = construct_sentence(ner_lines, position=word_pair_position[1])
 
-            if sentence1 == sentence2:
-                sentence_pairs.append(sentence1)
-            else:
-                sentence_pairs.append(sentence1 + " " + sentence2)
-
-            if (word_pair_position[0], word_pair_position[1]) in label_dict:
-                labels.append(
-                    label_dict[(word_pair_position[0], word_pair_position[1])]
-                )
-            else:
-                labels.append("non-edge")
-
-        ner_data.close()
-        flow_data.close()
-
-    return word_pairs, sentence_pairs, labels
-
-
-word_pairs, sentence_pairs, labels = construct_data()
-
-np_word_pairs, np_sentence_pairs, np_labels = (
-    np.array(word_pairs),
-    np.array(sentence_pairs),
-    np.array(labels),
+FULL_DATASET_DIR = (
+    SCRATCH_SPACE + "datasets/" + TARGET_CORPUS + "-directional-label-flow"
 )
+BUILD_KEY = build_key(SHARD_CACHE)
+
+# The full table only depends on the recipe shards, so every undersample factor
+# of a sweep reuses it once it has been built
+dataset, counts = load_full_dataset(FULL_DATASET_DIR, BUILD_KEY)
+
+if dataset is None:
+    # Rows are streamed straight into an on-disk Arrow table. A private cache
+    # directory makes sure the generator always runs, so the counters above are
+    # always filled in
+    BUILD_CACHE_DIR = tempfile.mkdtemp(dir=SCRATCH_SPACE)
+
+    dataset = Dataset.from_generator(
+        construct_data,
+        features=PAIR_FEATURES,
+        cache_dir=BUILD_CACHE_DIR,
+    )
 
-data_matrix = np.column_stack((np_word_pairs, np_sentence_pairs, np_labels))
+    dataset = save_full_dataset(
+        dataset,
+        FULL_DATASET_DIR,
+        BUILD_KEY,
+        [GLOBAL_INCLUDED_COUNT, GLOBAL_REJECTED_COUNT, GLOBAL_EDGE_COUNT],
+        PAIR_TABLE.sentence_table(),
+        PAIR_TABLE.label_names(),
+    )
+    shutil.rmtree(BUILD_CACHE_DIR)
+else:
+    GLOBAL_INCLUDED_COUNT, GLOBAL_REJECTED_COUNT, GLOBAL_EDGE_COUNT = counts
 
-df = pd.DataFrame(data_matrix, columns=["Word Pairs", "Sentence Pairs", "Label"])
+# Duplication and undersampling only select row indices, the sentences are
+# never copied out of the Arrow table
+labels = full_dataset_labels(dataset, FULL_DATASET_DIR)
+row_indices = np.arange(len(labels))
 
 if TARGET_CORPUS != "r-300":
     # Duplicate a 't-eq:RL' occurrence since there is only one occurrence in the r-100 and r-200 datasets
-    row = df.loc[df["Label"] == "t-eq:RL"]
-    df = pd.concat([df, row], ignore_index=True)
+    row_indices = np.concatenate([row_indices, np.flatnonzero(labels == "t-eq:RL")])
 
 
-def undersample(df, undersample_factor):
-    match_indices = df.index[df["Label"] == "non-edge"]
+def undersample(row_indices, undersample_factor):
+    match_indices = np.flatnonzero(labels[row_indices] == "non-edge")
     np.random.seed(SEED)
     delete_indices = np.random.choice(
         match_indices, size=int(len(match_indices) * undersample_factor), replace=False
     )
-    # delete_indices = np.random.choice(match_indices, size=(2 * len(match_indices) - df['Label'].value_counts().sum()), replace=False)
-    df = df.drop(delete_indices)
-    df = df.reset_index(drop=True)
+    # delete_indices = np.random.choice(match_indices, size=(2 * len(match_indices) - len(row_indices)), replace=False)
+    row_indices = np.delete(row_indices, delete_indices)
 
-    return df
+    return row_indices
 
 
-df = undersample(df, UNDERSAMPLE_FACTOR)
-df["Label"].value_counts()["non-edge"] / df["Label"].value_counts().sum()
+row_indices = undersample(row_indices, UNDERSAMPLE_FACTOR)
+np.mean(labels[row_indices] == "non-edge")
 
-edge_label_list = df["Label"].unique()
+edge_label_list = list(dict.fromkeys(labels[row_indices]))
 
-dataset = Dataset.from_pandas(df)
+# Encoding, shuffling and splitting a table of row numbers with the same labels
+# makes the same random draws as on the full table, so it picks out exactly the
+# rows of each split
+index_dataset = Dataset.from_dict({"Row": row_indices, "Label": labels[row_indices]})
 ClassLabels = ClassLabel(num_classes=len(edge_label_list), names=list(edge_label_list))
-dataset = dataset.class_encode_column("Label", ClassLabels)
-
-dataset = dataset.shuffle(seed=SEED)
-split_dataset = dataset.train_test_split(test_size=0.2, stratify_by_column="Label")
+index_dataset = index_dataset.class_encode_column("Label", ClassLabels)
 
-corpus_datasets = DatasetDict(
-    {
-        "train": split_dataset["train"],
-        "valid": split_dataset["test"],
-    }
+index_dataset = index_dataset.shuffle(seed=SEED)
+split_dataset = index_dataset.train_test_split(
+    test_size=0.2, stratify_by_column="Label"
 )
 
-corpus_datasets.save_to_disk(
+VIEW_DIR = (
     SCRATCH_SPACE
     + "datasets/"
     + TARGET_CORPUS
@@ -296,6 +254,14 @@ corpus_datasets.save_to_disk(
     + "-directional-label-flow"
 )
 
-df["Label"].value_counts().sum() - df["Label"].value_counts()[
-    "non-edge"
-] - GLOBAL_EDGE_COUNT == 1
+save_index_view(
+    VIEW_DIR,
+    FULL_DATASET_DIR,
+    index_dataset.features["Label"].names,
+    {"train": split_dataset["train"]["Row"], "valid": split_dataset["test"]["Row"]},
+)
+
+if SHARDS > 1:
+    save_rank_shards(VIEW_DIR, SHARDS)
+
+np.sum(labels[row_indices] != "non-edge") - GLOBAL_EDGE_COUNT == 1
@@ -10,17 +10,35 @@ Original file is located at
 import argparse
 
 # Imports for Data Processing
-import glob
 import pickle
+import shutil
+import sys
+import tempfile
 
 import numpy as np
-import pandas as pd
-from datasets import ClassLabel, Dataset, DatasetDict
+from datasets import ClassLabel, Dataset
 
 PROJECT_DIR = "/cluster/project2/COMP0029_17022125/NLP-FYP-HPC/"
 SCRATCH_SPACE = "/home/sejipark/NLP-FYP-HPC/"
 SEED = 2023
 
+sys.path.append(PROJECT_DIR)
+
+from shared.corpus_loader import load_corpus
+from shared.dataset_views import (
+    build_key,
+    full_dataset_labels,
+    load_full_dataset,
+    save_full_dataset,
+    save_index_view,
+)
+from shared.ingest import ingest_corpus
+from shared.pair_tables import PAIR_FEATURES, PairRows, PairTableBuilder
+from shared.parallel import build_shards
+from shared.rank_shards import save_rank_shards
+from shared.relation_matrix import RelationMatrix
+from shared.shard_cache import ShardCache
+
 parser = argparse.ArgumentParser()
 parser.add_argument(
     "--t", type=str, help="Recipe Corpus Target: can either be r-100, r-200, or r-300"
@@ -28,75 +46,43 @@ parser.add_argument(
 parser.add_argument(
     "--us", type=float, help="Undersample Factor: value between 0.0 and 1.0"
 )
+parser.add_argument(
+    "--workers",
+    type=int,
+    default=1,
+    help="Number of Worker Processes Constructing Recipes in Parallel",
+)
+parser.add_argument(
+    "--shards",
+    type=int,
+    default=1,
+    help="Number of Label-Stratified Rank Shards Written per Split",
+)
 
 args = parser.parse_args()
 
 TARGET_CORPUS = args.t
 UNDERSAMPLE_FACTOR = args.us
+WORKERS = args.workers
+SHARDS = args.shards
 
 GLOBAL_INCLUDED_COUNT, GLOBAL_REJECTED_COUNT, GLOBAL_EDGE_COUNT = 0, 0, 0
+PAIR_TABLE = PairTableBuilder()
 
-NER_FILES, FLOW_FILES = [], []
-
-if TARGET_CORPUS == "r-100" or TARGET_CORPUS == "r-200":
-    NER_FILES += glob.glob(PROJECT_DIR + TARGET_CORPUS + "/*.list")
-    FLOW_FILES += glob.glob(PROJECT_DIR + TARGET_CORPUS + "/*.flow")
-elif TARGET_CORPUS == "r-300":
-    for corpus in ["r-100", "r-200"]:
-        NER_FILES += glob.glob(PROJECT_DIR + corpus + "/*.list")
-        FLOW_FILES += glob.glob(PROJECT_DIR + corpus + "/*.flow")
-else:
-    raise Exception("Could not recognize target corpus")
-
-NER_FILES.sort()
-FLOW_FILES.sort()
-
-
-def encode_key(decoded_key):
-    if len(decoded_key) != 3:
-        raise Exception("Malformed Key During Encoding: Length != 3")
-
-    return str(decoded_key[0]) + ";" + str(decoded_key[1]) + ";" + str(decoded_key[2])
-
-
-def decode_key(encoded_key):
-    encoded_key = encoded_key.split(";")
-
-    if len(encoded_key) != 3:
-        raise Exception("Malformed Key During Decoding: Length != 3")
-    return (int(encoded_key[0]), int(encoded_key[1]), int(encoded_key[2]))
-
-
-def construct_recipe_dict(ner_lines, remove_iob=False):
-    word_dict = {}
-    ner_dict = {}
-
-    for line in ner_lines:
-        items = line.strip().split(" ")
-
-        key, word, ner_tag = encode_key(items[:3]), items[3], items[5]
-
-        if remove_iob:
-            ner_tag = ner_tag.replace("-B", "").replace("-I", "")
-
-        word_dict[key] = word
-        ner_dict[key] = ner_tag
-
-    return word_dict, ner_dict
+CORPUS = load_corpus(PROJECT_DIR, TARGET_CORPUS)
+RECIPES, RELATION_SET = ingest_corpus(CORPUS)
+SHARD_CACHE = ShardCache(
+    PROJECT_DIR, TARGET_CORPUS, "entity-marker", CORPUS, RELATION_SET
+)
 
 
-def construct_label_dict(flow_lines):
+def construct_label_dict(recipe):
     global GLOBAL_EDGE_COUNT
     recipe_dict = {}
 
-    for line in flow_lines:
+    for source_node, label, dest_node in recipe.flows:
         GLOBAL_EDGE_COUNT += 1
-        items = line.strip().split(" ")
 
-        source_node = (int(items[0]), int(items[1]), int(items[2]))
-        dest_node = (int(items[4]), int(items[5]), int(items[6]))
-
-        label = items[3]
         if label == "v":
             label = "v-tm"
         elif label == "s":
@@ -112,200 +98,126 @@ def construct_label_dict(flow_lines):
     return recipe_dict
 
 
-RELATION_SET = set()
-
-for ner_file, flow_file in zip(NER_FILES, FLOW_FILES):
-    ner_data, flow_data = open(ner_file, "r", encoding="utf-8"), open(
-        flow_file, "r", encoding="utf-8"
-    )
-    ner_lines, flow_lines = ner_data.readlines(), flow_data.readlines()
-
-    _, ner_dict = construct_recipe_dict(ner_lines)
-
-    for line in flow_lines:
-        items = line.strip().split(" ")
-        source_key, dest_key = encode_key(items[:3]), encode_key(items[4:])
-
-        relation = ner_dict[source_key] + "->" + ner_dict[dest_key]
-
-        RELATION_SET.add(relation)
-
-    ner_data.close()
-    flow_data.close()
-
 with open(
     PROJECT_DIR + TARGET_CORPUS + "-relation_set.pickle", "wb"
 ) as relation_set_file:
     pickle.dump(RELATION_SET, relation_set_file)
 
+RELATION_MATRIX = RelationMatrix.from_relation_set(RELATION_SET)
+RELATION_MATRIX.save(PROJECT_DIR + TARGET_CORPUS + "-relation_matrix.npz")
 
-def generate_pairs(ner_lines, ner_dict):
+
+def generate_pairs(recipe):
     global GLOBAL_INCLUDED_COUNT
     global GLOBAL_REJECTED_COUNT
 
-    positions, pairs = [], []
-
-    for line in ner_lines:
-        items = line.split(" ")
-        label = items[5].replace("\n", "")
+    positions, ner_tags = [], []
 
+    for key, _, _, label in recipe.tokens:
         if "-I" not in label and label != "O":
-            position = (int(items[0]), int(items[1]), int(items[2]))
-            positions.append(position)
-
-    for i in range(len(positions)):
-        for j in range(i + 1, len(positions)):
-            source_key, dest_key = encode_key(positions[i]), encode_key(positions[j])
-            source_ner, dest_ner = ner_dict[source_key], ner_dict[dest_key]
-
-            flow1 = source_ner + "->" + dest_ner
-            flow2 = dest_ner + "->" + source_ner
-
-            if flow1 in RELATION_SET or flow2 in RELATION_SET:
-                pairs.append((positions[i], positions[j]))
-                GLOBAL_INCLUDED_COUNT += 1
-            else:
-                GLOBAL_REJECTED_COUNT += 1
-
-    return pairs
-
-
-def construct_sentence(
-    ner_lines, ner_dict, position, target_word_positions, typed=False
-):
-    first_word = True
-    sentence = ""
-
-    marking = -1
-    marking_ner_tag = None
-
-    for line in ner_lines:
-        items = line.split(" ")
-        items[0], items[1], items[2] = int(items[0]), int(items[1]), int(items[2])
-
-        if (position[0], position[1]) == (items[0], items[1]):
-            if marking != -1:
-                word_key = encode_key((items[0], items[1], items[2]))
-
-                if marking_ner_tag.replace("-B", "-I") != ner_dict[word_key]:
-                    sentence += " </e" + str(marking) + ">"
-                    marking, marking_ner_tag = -1, None
-
-            if not first_word:
-                sentence += " "
+            positions.append(key)
+            ner_tags.append(label)
 
-            first_word = False
-            word_added = False
+    sources, dests, num_rejected = RELATION_MATRIX.candidate_pairs(ner_tags)
 
-            for index, target_word_position in enumerate(target_word_positions):
-                if target_word_position == (items[0], items[1], items[2]):
-                    word_key = encode_key(target_word_position)
-                    marking, marking_ner_tag = index + 1, ner_dict[word_key]
+    GLOBAL_INCLUDED_COUNT += len(sources)
+    GLOBAL_REJECTED_COUNT += num_rejected
 
-                    sentence += "<e" + str(marking) + "> " + items[3]
-                    word_added = True
+    return [
+        (positions[source], positions[dest])
+        for source, dest in zip(sources.tolist(), dests.tolist())
+    ]
 
-            if not word_added:
-                sentence += items[3]
 
-    if marking != -1:
-        sentence += " </e" + str(marking) + ">"
+def construct_recipe_data(recipe):
+    pair_rows = PairRows(recipe)
+    label_dict = construct_label_dict(recipe)
 
-    return sentence
+    for word_pair in generate_pairs(recipe):
+        if (word_pair[0], word_pair[1]) in label_dict:
+            pair_rows.append(*word_pair, label_dict[(word_pair[0], word_pair[1])])
+        else:
+            pair_rows.append(*word_pair, "non-edge")
 
+    return pair_rows.shard()
 
-def check_sentence_sanity(sentence):
-    contains_marking = False
 
-    for opening_tag, closing_tag in [("<e1>", "</e1>"), ("<e2>", "</e2>")]:
-        if opening_tag in sentence:
-            contains_marking = True
+def construct_shard(recipe_index):
+    # Counters are accumulated per recipe and summed by the parent process,
+    # since worker processes cannot update the parent's globals
+    global GLOBAL_INCLUDED_COUNT, GLOBAL_REJECTED_COUNT, GLOBAL_EDGE_COUNT
+    GLOBAL_INCLUDED_COUNT, GLOBAL_REJECTED_COUNT, GLOBAL_EDGE_COUNT = 0, 0, 0
 
-            if closing_tag not in sentence:
-                raise Exception(closing_tag + " is missing!")
+    rows = construct_recipe_data(RECIPES[recipe_index])
 
-    if not contains_marking:
-        raise Exception("no tags found!")
+    return rows, (GLOBAL_INCLUDED_COUNT, GLOBAL_REJECTED_COUNT, GLOBAL_EDGE_COUNT)
 
 
 def construct_data():
-    first_sentences, second_sentences, labels = [], [], []
-
-    for ner_file, flow_file in zip(NER_FILES, FLOW_FILES):
-        ner_data, flow_data = open(ner_file, "r", encoding="utf-8"), open(
-            flow_file, "r", encoding="utf-8"
-        )
-
-        ner_lines, flow_lines = ner_data.readlines(), flow_data.readlines()
+    global GLOBAL_INCLUDED_COUNT, GLOBAL_REJECTED_COUNT, GLOBAL_EDGE_COUNT
 
-        word_dict, ner_dict = construct_recipe_dict(ner_lines)
-        label_dict = construct_label_dict(flow_lines)
+    counts = [0, 0, 0]
 
-        if word_dict.keys() != ner_dict.keys():
-            raise Exception("Malformed Word and NER Dictionary")
+    for shard, shard_counts in build_shards(
+        construct_shard, len(RECIPES), WORKERS, SHARD_CACHE
+    ):
+        yield from PAIR_TABLE.add_shard(shard)
 
-        word_pairs = generate_pairs(ner_lines, ner_dict)
+        counts = [
+            count + shard_count for count, shard_count in zip(counts, shard_counts)
+        ]
 
-        for word_pair in word_pairs:
-            sentence1 = construct_sentence(
-                ner_lines,
-                ner_dict,
-                position=word_pair[0],
-                target_word_positions=word_pair,
-            )
-            sentence2 = construct_sentence(
-                ner_lines,
-                ner_dict,
-                position=word_pair[1],
-                target_word_positions=word_pair,
-            )
+    GLOBAL_INCLUDED_COUNT, GLOBAL_REJECTED_COUNT, GLOBAL_EDGE_COUNT = counts
 
-            check_sentence_sanity(sentence1)
-            check_sentence_sanity(sentence2)
 
-            if sentence1 == sentence2:
-                first_sentences.append(sentence1)
-                second_sentences.append(None)
-            else:
-                first_sentences.append(sentence1)
-                second_sentences.append(sentence2)
+FULL_DATASET_DIR = SCRATCH_SPACE + "datasets/" + TARGET_CORPUS + "-entity-marked-flow"
+BUILD_KEY = build_key(SHARD_CACHE)
 
-            if (word_pair[0], word_pair[1]) in label_dict:
-                labels.append(label_dict[(word_pair[0], word_pair[1])])
-            else:
-                labels.append("non-edge")
+# The full table only depends on the recipe shards, so every undersample factor
+# of a sweep reuses it once it has been built
+dataset, counts = load_full_dataset(FULL_DATASET_DIR, BUILD_KEY)
 
-        ner_data.close()
-        flow_data.close()
+if dataset is None:
+    # Rows are streamed straight into an on-disk Arrow table. A private cache
+    # directory makes sure the generator always runs, so the counters above are
+    # always filled in
+    BUILD_CACHE_DIR = tempfile.mkdtemp(dir=SCRATCH_SPACE)
 
-    return first_sentences, second_sentences, labels
-
-
-first_sentences, second_sentences, labels = construct_data()
-
-np_first_sentences, np_second_sentences, np_labels = (
-    np.array(first_sentences),
-    np.array(second_sentences),
-    np.array(labels),
-)
+    dataset = Dataset.from_generator(
+        construct_data,
+        features=PAIR_FEATURES,
+        cache_dir=BUILD_CACHE_DIR,
+    )
 
-data_matrix = np.column_stack((np_first_sentences, np_second_sentences, np_labels))
+    dataset = save_full_dataset(
+        dataset,
+        FULL_DATASET_DIR,
+        BUILD_KEY,
+        [GLOBAL_INCLUDED_COUNT, GLOBAL_REJECTED_COUNT, GLOBAL_EDGE_COUNT],
+        PAIR_TABLE.sentence_table(),
+        PAIR_TABLE.label_names(),
+    )
+    shutil.rmtree(BUILD_CACHE_DIR)
+else:
+    GLOBAL_INCLUDED_COUNT, GLOBAL_REJECTED_COUNT, GLOBAL_EDGE_COUNT = counts
 
-df = pd.DataFrame(data_matrix, columns=["First Sentence", "Second Sentence", "Label"])
+# Duplication and undersampling only select row indices, the sentences are
+# never copied out of the Arrow table
+labels = full_dataset_labels(dataset, FULL_DATASET_DIR)
+row_indices = np.arange(len(labels))
 
 if TARGET_CORPUS != "r-300":
     # Duplicate a 't-eq:RL' occurrence since there is only one occurrence in the r-100 and r-200 datasets
-    row = df.loc[df["Label"] == "t-eq:RL"]
-    df = pd.concat([df, row], ignore_index=True)
+    row_indices = np.concatenate([row_indices, np.flatnonzero(labels == "t-eq:RL")])
 
 
-def undersample(df, undersample_factor):
-    match_indices = df.index[df["Label"] == "non-edge"]
+def undersample(row_indices, undersample_factor):
+    match_indices = np.flatnonzero(labels[row_indices] == "non-edge")
     np.random.seed(SEED)
     if undersample_factor == 1:
         delete_indices = np.random.choice(
             match_indices,
-            size=(2 * len(match_indices) - df["Label"].value_counts().sum()),
+            size=(2 * len(match_indices) - len(row_indices)),
             replace=False,
         )
     else:
@@ -314,32 +226,29 @@ def undersample(df, undersample_factor):
             size=int(len(match_indices) * undersample_factor),
             replace=False,
         )
-    df = df.drop(delete_indices)
-    df = df.reset_index(drop=True)
+    row_indices = np.delete(row_indices, delete_indices)
 
-    return df
+    return row_indices
 
 
-df = undersample(df, UNDERSAMPLE_FACTOR)
-df["Label"].value_counts()["non-edge"] / df["Label"].value_counts().sum()
+row_indices = undersample(row_indices, UNDERSAMPLE_FACTOR)
+np.mean(labels[row_indices] == "non-edge")
 
-edge_label_list = df["Label"].unique()
+edge_label_list = list(dict.fromkeys(labels[row_indices]))
 
-dataset = Dataset.from_pandas(df)
+# Encoding, shuffling and splitting a table of row numbers with the same labels
+# makes the same random draws as on the full table, so it picks out exactly the
+# rows of each split
+index_dataset = Dataset.from_dict({"Row": row_indices, "Label": labels[row_indices]})
 ClassLabels = ClassLabel(num_classes=len(edge_label_list), names=list(edge_label_list))
-dataset = dataset.class_encode_column("Label", ClassLabels)
-
-dataset = dataset.shuffle(seed=SEED)
-split_dataset = dataset.train_test_split(test_size=0.2, stratify_by_column="Label")
+index_dataset = index_dataset.class_encode_column("Label", ClassLabels)
 
-corpus_datasets = DatasetDict(
-    {
-        "train": split_dataset["train"],
-        "valid": split_dataset["test"],
-    }
+index_dataset = index_dataset.shuffle(seed=SEED)
+split_dataset = index_dataset.train_test_split(
+    test_size=0.2, stratify_by_column="Label"
 )
 
-corpus_datasets.save_to_disk(
+VIEW_DIR = (
     SCRATCH_SPACE
     + "datasets/"
     + TARGET_CORPUS
@@ -348,6 +257,14 @@ corpus_datasets.save_to_disk(
     + "-entity-marked-flow"
 )
 
-df["Label"].value_counts().sum() - df["Label"].value_counts()[
-    "non-edge"
-] - GLOBAL_EDGE_COUNT <= 1
+save_index_view(
+    VIEW_DIR,
+    FULL_DATASET_DIR,
+    index_dataset.features["Label"].names,
+    {"train": split_dataset["train"]["Row"], "valid": split_dataset["test"]["Row"]},
+)
+
+if SHARDS > 1:
+    save_rank_shards(VIEW_DIR, SHARDS)
+
+np.sum(labels[row_indices] != "non-edge") - GLOBAL_EDGE_COUNT <= 1
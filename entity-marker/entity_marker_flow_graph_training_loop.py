@@ -8,7 +8,9 @@ Original file is located at
 """
 
 import argparse
+import math
 import os
+import sys
 import time
 from collections import defaultdict
 
@@ -17,8 +19,8 @@ import numpy as np
 # Imports for Data Processing
 import pandas as pd
 import torch
-from accelerate import Accelerator
-from datasets import load_from_disk
+from accelerate import skip_first_batches
+from accelerate.utils import gather_object
 from matplotlib import pyplot as plt
 from sklearn.metrics import (
     classification_report,
@@ -30,7 +32,6 @@ from torch.utils.data import DataLoader
 from tqdm.auto import tqdm
 from transformers import (
     AutoModelForSequenceClassification,
-    AutoTokenizer,
     DataCollatorWithPadding,
     get_scheduler,
 )
@@ -38,6 +39,43 @@ from transformers import (
 PROJECT_DIR = "/cluster/project2/COMP0029_17022125/NLP-FYP-HPC/"
 SCRATCH_SPACE = "/home/sejipark/NLP-FYP-HPC/"
 MODEL_CHECKPOINT = "bert-base-cased"
+MAX_LENGTH = 128
+
+sys.path.append(PROJECT_DIR)
+
+from shared.batch_tuning import tune_batch_size
+from shared.checkpointing import (
+    CheckpointWriter,
+    load_checkpoint,
+    restore_training_state,
+    training_state,
+)
+from shared.dataset_views import load_index_view
+from shared.early_stopping import (
+    MONITORED_METRICS,
+    EarlyStopping,
+    fixed_subsample,
+    restore_best_model,
+)
+from shared.fast_mode import (
+    compare_fast_run,
+    compile_forward,
+    fast_accelerator,
+    save_step_time,
+)
+from shared.length_grouping import (
+    LengthGroupedBatchSampler,
+    report_padding,
+    sequence_lengths,
+)
+from shared.manifest import load_manifest, report_manifest
+from shared.markers import MarkerTokenizer
+from shared.negative_resampling import non_edge_resampler
+from shared.pair_tables import load_sentence_table, marked_sentence_pairs
+from shared.pretrained_cache import pretrained_model, pretrained_tokenizer
+from shared.rank_shards import load_rank_shard
+from shared.tensor_loading import tensor_dataloader, tokenizer_pad_values
+from shared.tokenization_cache import tokenize_datasets
 
 parser = argparse.ArgumentParser()
 parser.add_argument(
@@ -50,6 +88,91 @@ parser.add_argument("--epochs", type=int, help="Number of Epochs")
 parser.add_argument(
     "--weighted", action="store_true", help="Toggling Weighted Cross Entropy Loss"
 )
+parser.add_argument(
+    "--length-grouped",
+    action="store_true",
+    help="Toggling Length-Grouped Batching with Dynamic Padding",
+)
+parser.add_argument(
+    "--mmap-loading",
+    action="store_true",
+    help="Toggling Batch Loading from Memory-Mapped Tensors",
+)
+parser.add_argument(
+    "--workers",
+    type=int,
+    default=2,
+    help="Number of DataLoader Worker Processes for Memory-Mapped Loading",
+)
+parser.add_argument(
+    "--fast",
+    action="store_true",
+    help="Toggling bf16 Autocast and a Compiled Model Forward",
+)
+parser.add_argument(
+    "--batch-size",
+    type=int,
+    default=16,
+    help="Number of Examples per Optimizer Step",
+)
+parser.add_argument(
+    "--auto-batch",
+    action="store_true",
+    help="Toggling the Micro-Batch Size Probe with Gradient Accumulation",
+)
+parser.add_argument(
+    "--resample",
+    action="store_true",
+    help="Toggling Per-Epoch Resampling of Non-Edge Examples from the 0.0 Dataset",
+)
+
+parser.add_argument(
+    "--checkpoint-steps",
+    type=int,
+    default=0,
+    help="Number of Optimizer Steps between Checkpoints, 0 for No Checkpoints",
+)
+parser.add_argument(
+    "--resume",
+    action="store_true",
+    help="Toggling Resuming the Run from its Last Checkpoint",
+)
+parser.add_argument(
+    "--early-stopping",
+    action="store_true",
+    help="Toggling Early Stopping on a Validation Metric, Keeping Only the Best Model",
+)
+parser.add_argument(
+    "--monitor",
+    choices=list(MONITORED_METRICS),
+    default="macro-edge-f1",
+    help="Validation Metric Monitored for Early Stopping",
+)
+parser.add_argument(
+    "--patience",
+    type=int,
+    default=2,
+    help="Number of Evaluations without Improvement before Stopping Early",
+)
+parser.add_argument(
+    "--min-delta",
+    type=float,
+    default=0.0,
+    help="Minimum Improvement of the Monitored Metric in Percentage Points",
+)
+parser.add_argument(
+    "--eval-steps",
+    type=int,
+    default=0,
+    help="Number of Optimizer Steps between Early Stopping Evaluations on a "
+    + "Validation Subsample, 0 for Full Evaluations at Epoch Ends",
+)
+parser.add_argument(
+    "--eval-subsample",
+    type=int,
+    default=2000,
+    help="Number of Validation Examples Evaluated every --eval-steps",
+)
 
 args = parser.parse_args()
 
@@ -66,6 +189,24 @@ OUTPUT_DIR = (
     + "/"
 )
 WEIGHTED_CROSS_ENTROPY = args.weighted
+LENGTH_GROUPED = args.length_grouped
+MMAP_LOADING = args.mmap_loading
+WORKERS = args.workers
+FAST = args.fast
+BATCH_SIZE = args.batch_size
+AUTO_BATCH = args.auto_batch
+RESAMPLE = args.resample
+CHECKPOINT_STEPS = args.checkpoint_steps
+RESUME = args.resume
+EARLY_STOPPING = args.early_stopping
+MONITOR = MONITORED_METRICS[args.monitor]
+PATIENCE = args.patience
+MIN_DELTA = args.min_delta
+EVAL_STEPS = args.eval_steps
+EVAL_SUBSAMPLE = args.eval_subsample
+
+# Length-grouped batches are only padded up to their own longest sequence
+PADDING = False if LENGTH_GROUPED else "max_length"
 
 if WEIGHTED_CROSS_ENTROPY:
     OUTPUT_DIR = (
@@ -79,6 +220,23 @@ if WEIGHTED_CROSS_ENTROPY:
         + "/"
     )
 
+# Resampled runs train on other examples than the fixed undersample runs of
+# the same factor, so they are saved and checkpointed apart from them
+if RESAMPLE:
+    OUTPUT_DIR = OUTPUT_DIR + "resampled/"
+
+# Fast runs are saved next to the fp32 run they are compared against
+FP32_OUTPUT_DIR = OUTPUT_DIR
+
+if FAST:
+    OUTPUT_DIR = OUTPUT_DIR + "fast/"
+
+# Checkpoints of the run are kept in the scratch space, mirroring its outputs
+CHECKPOINT_DIR = OUTPUT_DIR.replace(
+    PROJECT_DIR + "outputs/", SCRATCH_SPACE + "checkpoints/"
+)
+MODEL_DIR = OUTPUT_DIR + "model/" + TARGET_CORPUS + "-" + MODEL_CHECKPOINT + "-model"
+
 if not os.path.exists(OUTPUT_DIR):
     os.makedirs(OUTPUT_DIR)
 
@@ -87,54 +245,158 @@ device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 if torch.cuda.is_available():
     torch.cuda.set_device(0)
 
-corpus_datasets = load_from_disk(
+accelerator = fast_accelerator(FAST)
+
+# Resampling draws the non-edge examples of every epoch from the dataset that
+# kept all of them, so one dataset serves every undersample factor
+DATASET_DIR = (
     SCRATCH_SPACE
     + "datasets/"
     + TARGET_CORPUS
     + "-"
-    + str(UNDERSAMPLE_FACTOR)
+    + str(0.0 if RESAMPLE else UNDERSAMPLE_FACTOR)
     + "-entity-marked-flow"
 )
 
-tokenizer = AutoTokenizer.from_pretrained(MODEL_CHECKPOINT)
-tokenizer.add_tokens(["<e1>", "</e1>", "<e2>", "</e2>"], special_tokens=True)
+# Ranks of a job the view was sharded for only load their own rows
+corpus_datasets = load_rank_shard(
+    DATASET_DIR, accelerator.process_index, accelerator.num_processes
+)
+RANK_SHARDED = corpus_datasets is not None
+
+if not RANK_SHARDED:
+    corpus_datasets = load_index_view(DATASET_DIR)
+
+manifest = load_manifest(DATASET_DIR)
+report_manifest(manifest)
+sentence_table = load_sentence_table(DATASET_DIR)
+
+MARKERS = ["<e1>", "</e1>", "<e2>", "</e2>"]
+
+tokenizer = pretrained_tokenizer(MODEL_CHECKPOINT)
+tokenizer.add_tokens(MARKERS, special_tokens=True)
 tokenizer.save_pretrained(
     OUTPUT_DIR + "tokenizer/" + TARGET_CORPUS + "-" + MODEL_CHECKPOINT + "-tokenizer"
 )
 
+marker_tokenizer = MarkerTokenizer(tokenizer, MARKERS)
+
 
 def tokenize_function(data):
-    if data["Second Sentence"] is None:
-        return tokenizer(
-            data["First Sentence"],
-            add_special_tokens=True,
-            max_length=128,
-            padding="max_length",
-        )
-    return tokenizer(
-        data["First Sentence"],
-        data["Second Sentence"],
-        add_special_tokens=True,
-        max_length=128,
-        padding="max_length",
+    first_sentences, second_sentences = marked_sentence_pairs(data, sentence_table)
+
+    return marker_tokenizer.encode(
+        first_sentences, second_sentences, max_length=MAX_LENGTH, padding=PADDING
     )
 
 
-tokenized_datasets = corpus_datasets.map(tokenize_function, batched=False)
+tokenized_datasets = tokenize_datasets(
+    SCRATCH_SPACE + "cache/tokenized/",
+    "entity-marker",
+    corpus_datasets,
+    tokenizer,
+    tokenize_function,
+    MAX_LENGTH,
+    PADDING,
+    remove_columns=[
+        column for column in corpus_datasets["train"].column_names if column != "Label"
+    ],
+)
 data_collator = DataCollatorWithPadding(tokenizer=tokenizer)
 
-tokenized_datasets = tokenized_datasets.remove_columns(
-    ["First Sentence", "Second Sentence"]
-)
 tokenized_datasets = tokenized_datasets.rename_column("Label", "labels")
 
-train_dataloader = DataLoader(
-    tokenized_datasets["train"], batch_size=16, collate_fn=data_collator
-)
+MICRO_BATCH_SIZE, ACCUMULATION_STEPS = BATCH_SIZE, 1
+
+if AUTO_BATCH:
+    MICRO_BATCH_SIZE, ACCUMULATION_STEPS = tune_batch_size(
+        AutoModelForSequenceClassification,
+        MODEL_CHECKPOINT,
+        len(tokenized_datasets["train"].features["labels"].names),
+        BATCH_SIZE,
+        MAX_LENGTH,
+        tokenizer.vocab_size,
+        accelerator,
+        fast=FAST,
+        dynamic_shapes=LENGTH_GROUPED,
+    )
 
-eval_dataloader = DataLoader(
-    tokenized_datasets["valid"], batch_size=16, collate_fn=data_collator
-)
+train_resampler, eval_resampler = None, None
+
+if RESAMPLE:
+    train_resampler = non_edge_resampler(
+        tokenized_datasets["train"], UNDERSAMPLE_FACTOR, balanced_at_one=True
+    )
+
+    # Validation keeps a single draw, so every epoch is evaluated on the same
+    # examples
+    eval_resampler = non_edge_resampler(
+        tokenized_datasets["valid"],
+        UNDERSAMPLE_FACTOR,
+        balanced_at_one=True,
+        shuffle=False,
+    )
+
+if LENGTH_GROUPED:
+    train_sampler = LengthGroupedBatchSampler(
+        sequence_lengths(tokenized_datasets["train"]),
+        batch_size=MICRO_BATCH_SIZE,
+        sampler=train_resampler,
+    )
+    eval_sampler = LengthGroupedBatchSampler(
+        sequence_lengths(tokenized_datasets["valid"]),
+        batch_size=MICRO_BATCH_SIZE,
+        shuffle=False,
+        sampler=eval_resampler,
+    )
+
+    report_padding("Train", train_sampler.lengths, train_sampler, MAX_LENGTH)
+    report_padding("Valid", eval_sampler.lengths, eval_sampler, MAX_LENGTH)
+
+    train_batching = {"batch_sampler": train_sampler}
+    eval_batching = {"batch_sampler": eval_sampler}
+else:
+    train_batching = {"batch_size": MICRO_BATCH_SIZE, "sampler": train_resampler}
+    eval_batching = {"batch_size": MICRO_BATCH_SIZE, "sampler": eval_resampler}
+
+if MMAP_LOADING:
+    pad_values = tokenizer_pad_values(tokenizer)
+
+    train_dataloader = tensor_dataloader(
+        tokenized_datasets["train"], pad_values, WORKERS, **train_batching
+    )
+    eval_dataloader = tensor_dataloader(
+        tokenized_datasets["valid"], pad_values, WORKERS, **eval_batching
+    )
+else:
+    train_dataloader = DataLoader(
+        tokenized_datasets["train"], collate_fn=data_collator, **train_batching
+    )
+    eval_dataloader = DataLoader(
+        tokenized_datasets["valid"], collate_fn=data_collator, **eval_batching
+    )
+
+subsample_dataloader = None
+
+if EARLY_STOPPING and EVAL_STEPS > 0:
+    # Step evaluations always see the same subsample of the validation examples
+    if RESAMPLE:
+        eval_indices = eval_resampler.indices()
+    else:
+        eval_indices = range(len(tokenized_datasets["valid"]))
+
+    subsample_dataset = tokenized_datasets["valid"].select(
+        fixed_subsample(eval_indices, EVAL_SUBSAMPLE)
+    )
+
+    if MMAP_LOADING:
+        subsample_dataloader = tensor_dataloader(
+            subsample_dataset, pad_values, WORKERS, batch_size=MICRO_BATCH_SIZE
+        )
+    else:
+        subsample_dataloader = DataLoader(
+            subsample_dataset, collate_fn=data_collator, batch_size=MICRO_BATCH_SIZE
+        )
 
 label_names = tokenized_datasets["train"].features["labels"].names
 
@@ -149,6 +411,8 @@ def evaluate(dataloader_val):
     pred_vals, true_vals = [], []
 
     for batch in dataloader_val:
+        batch = {name: tensor.to(accelerator.device) for name, tensor in batch.items()}
+
         with torch.no_grad():
             outputs = flow_model(**batch)
 
@@ -164,6 +428,15 @@ def evaluate(dataloader_val):
             pred_vals.append(prediction)
             true_vals.append(label_id)
 
+    num_val_batches = len(dataloader_val)
+
+    if RANK_SHARDED:
+        # Every rank only evaluated its own shard of the valid split
+        pred_vals = gather_object(pred_vals)
+        true_vals = gather_object(true_vals)
+        loss_val_total = sum(gather_object([loss_val_total]))
+        num_val_batches = sum(gather_object([num_val_batches]))
+
     labeled_preds = [label_names[pred_val] for pred_val in pred_vals]
     labeled_trues = [label_names[true_val] for true_val in true_vals]
 
@@ -199,7 +472,7 @@ def evaluate(dataloader_val):
         "Non-Edge F1": non_edge_f1,
     }
 
-    loss_val_avg = loss_val_total / len(dataloader_val)
+    loss_val_avg = loss_val_total / num_val_batches
 
     return perf_metrics, loss_val_avg, pred_vals, true_vals
 
@@ -209,20 +482,21 @@ def evaluate(dataloader_val):
 weights = []
 
 if WEIGHTED_CROSS_ENTROPY:
-    num_labels = len(label_names)
-    frequencies = [0] * num_labels
+    frequencies = manifest["splits"]["train"]["label_counts"]
 
-    for batch in train_dataloader:
-        for label in batch["labels"]:
-            frequencies[label] += 1
+    if RESAMPLE:
+        # Every epoch trains on the same number of resampled non-edge examples
+        frequencies[label2id["non-edge"]] = train_resampler.num_kept
 
     weights = [1 / frequency for frequency in frequencies]
     weights = torch.tensor(weights).to(device)
 
-accelerator = Accelerator()
-
-flow_model = AutoModelForSequenceClassification.from_pretrained(
-    MODEL_CHECKPOINT, id2label=id2label, label2id=label2id, num_labels=len(label_names)
+flow_model = pretrained_model(
+    AutoModelForSequenceClassification,
+    MODEL_CHECKPOINT,
+    id2label=id2label,
+    label2id=label2id,
+    num_labels=len(label_names),
 )
 
 flow_model.resize_token_embeddings(len(tokenizer))
@@ -244,9 +518,22 @@ optimizer_grouped_parameters = [
 
 optimizer = torch.optim.AdamW(optimizer_grouped_parameters, lr=3e-5)
 
-train_dl, eval_dl, flow_model, optimizer = accelerator.prepare(
-    train_dataloader, eval_dataloader, flow_model, optimizer
-)
+if FAST:
+    flow_model = compile_forward(flow_model, dynamic_shapes=LENGTH_GROUPED)
+
+if RANK_SHARDED:
+    # The dataloaders already only cover the shard of this rank
+    flow_model, optimizer = accelerator.prepare(flow_model, optimizer)
+    train_dl, eval_dl = train_dataloader, eval_dataloader
+    subsample_dl = subsample_dataloader
+else:
+    train_dl, eval_dl, flow_model, optimizer = accelerator.prepare(
+        train_dataloader, eval_dataloader, flow_model, optimizer
+    )
+    subsample_dl = None
+
+    if subsample_dataloader is not None:
+        subsample_dl = accelerator.prepare(subsample_dataloader)
 
 loss_fct = torch.nn.CrossEntropyLoss()
 
@@ -254,7 +541,7 @@ if WEIGHTED_CROSS_ENTROPY:
     loss_fct = torch.nn.CrossEntropyLoss(weight=weights)
 
 epochs = args.epochs
-num_training_steps = epochs * len(train_dl)
+num_training_steps = epochs * math.ceil(len(train_dl) / ACCUMULATION_STEPS)
 lr_scheduler = get_scheduler(
     "linear",
     optimizer=optimizer,
@@ -266,29 +553,132 @@ progress_bar = tqdm(range(num_training_steps))
 
 overall_metrics = defaultdict(list)
 train_loss_vals, eval_loss_vals = [], []
+train_epoch_times, train_epoch_steps = [], []
+
+checkpoint_writer = CheckpointWriter(CHECKPOINT_DIR, accelerator.is_main_process)
+early_stopping = EarlyStopping(PATIENCE, MIN_DELTA)
+start_epoch, resumed_step, resumed_loss_sum, completed_steps = 0, 0, 0, 0
+
+
+def save_checkpoint(epoch, step, train_loss_sum):
+    # step is the number of micro-batches of the epoch trained on so far
+    progress = {
+        "epoch": epoch,
+        "step": step,
+        "train_loss_sum": train_loss_sum,
+        "completed_steps": completed_steps,
+        "num_training_steps": num_training_steps,
+        "train_loss_vals": train_loss_vals,
+        "eval_loss_vals": eval_loss_vals,
+        "overall_metrics": dict(overall_metrics),
+        "train_epoch_times": train_epoch_times,
+        "train_epoch_steps": train_epoch_steps,
+        "early_stopping": early_stopping.state_dict(),
+    }
+
+    checkpoint_writer.save(
+        training_state(accelerator, flow_model, optimizer, lr_scheduler, progress)
+    )
+
+
+def track_best(perf_metrics):
+    # Only the best model so far is kept on disk
+    if early_stopping.update(perf_metrics[MONITOR] * 100):
+        print("Best " + MONITOR + ": " + str(early_stopping.best))
+        checkpoint_writer.save_model(accelerator.unwrap_model(flow_model), MODEL_DIR)
+
+
+checkpoint = load_checkpoint(CHECKPOINT_DIR) if RESUME else None
+
+if checkpoint is not None:
+    progress = restore_training_state(
+        checkpoint, accelerator, flow_model, optimizer, lr_scheduler, num_training_steps
+    )
+
+    start_epoch, resumed_step = progress["epoch"], progress["step"]
+    resumed_loss_sum = progress["train_loss_sum"]
+    completed_steps = progress["completed_steps"]
+    train_loss_vals = progress["train_loss_vals"]
+    eval_loss_vals = progress["eval_loss_vals"]
+    overall_metrics.update(progress["overall_metrics"])
+    train_epoch_times = progress["train_epoch_times"]
+    train_epoch_steps = progress["train_epoch_steps"]
+    early_stopping.load_state_dict(progress["early_stopping"])
+
+    progress_bar.update(completed_steps)
+    del checkpoint
 
 training_start_time = time.time()
 
-for epoch in range(epochs):
-    # Training
-    train_loss_sum = 0
+for epoch in range(start_epoch, epochs):
+    if EARLY_STOPPING and early_stopping.stopped:
+        print(
+            "Stopped Early after "
+            + str(epoch)
+            + " Epochs with Best "
+            + MONITOR
+            + ": "
+            + str(early_stopping.best)
+        )
+        break
+
+    if LENGTH_GROUPED:
+        train_sampler.set_epoch(epoch)
+    elif RESAMPLE:
+        train_resampler.set_epoch(epoch)
+
+    # Training, a resumed epoch skips the batches it trained on before its
+    # checkpoint
+    first_step, train_loss_sum = resumed_step, resumed_loss_sum
+    resumed_step, resumed_loss_sum = 0, 0
+    epoch_dl = skip_first_batches(train_dl, first_step) if first_step else train_dl
+
     flow_model.train()
-    for batch in train_dl:
+    train_epoch_start_time = time.time()
+
+    for step, batch in enumerate(epoch_dl, start=first_step):
+        batch = {name: tensor.to(accelerator.device) for name, tensor in batch.items()}
         labels = batch.get("labels")
         outputs = flow_model(**batch)
         logits = outputs.get("logits")
 
-        loss = loss_fct(logits.view(-1, flow_model.config.num_labels), labels.view(-1))
+        loss = loss_fct(logits.view(-1, len(label_names)), labels.view(-1))
         train_loss_sum += loss.item()
 
-        accelerator.backward(loss)
-
-        optimizer.step()
-        lr_scheduler.step()
-        optimizer.zero_grad()
-        progress_bar.update(1)
-
-    train_loss = train_loss_sum / len(train_dl)
+        # The last accumulation group of the epoch may hold fewer
+        # micro-batches, which are averaged over their own number
+        group_start = step - step % ACCUMULATION_STEPS
+        group_size = min(ACCUMULATION_STEPS, len(train_dl) - group_start)
+        accelerator.backward(loss / group_size)
+
+        # Step once every ACCUMULATION_STEPS micro-batches and at the end of
+        # the epoch
+        if (step + 1) % ACCUMULATION_STEPS == 0 or step + 1 == len(train_dl):
+            optimizer.step()
+            lr_scheduler.step()
+            optimizer.zero_grad()
+            progress_bar.update(1)
+            completed_steps += 1
+
+            if EARLY_STOPPING and EVAL_STEPS > 0 and completed_steps % EVAL_STEPS == 0:
+                track_best(evaluate(subsample_dl)[0])
+                flow_model.train()
+
+            if (
+                CHECKPOINT_STEPS > 0
+                and completed_steps % CHECKPOINT_STEPS == 0
+                and step + 1 < len(train_dl)
+            ):
+                save_checkpoint(epoch, step + 1, train_loss_sum)
+
+            if EARLY_STOPPING and early_stopping.stopped:
+                break
+
+    train_epoch_times.append(time.time() - train_epoch_start_time)
+    # A resumed or early stopped epoch only timed part of its micro-batches
+    train_epoch_steps.append(step + 1 - first_step)
+    # An epoch stopped early only trained on its first step + 1 micro-batches
+    train_loss = train_loss_sum / (step + 1)
     train_loss_vals.append(train_loss)
 
     # Evaluation
@@ -299,20 +689,30 @@ for epoch in range(epochs):
 
     eval_loss_vals.append(val_loss)
 
+    if EARLY_STOPPING and EVAL_STEPS == 0:
+        track_best(perf_metrics)
+
+    # Checkpointing runs also checkpoint every epoch end
+    if CHECKPOINT_STEPS > 0:
+        save_checkpoint(epoch + 1, 0, 0)
+
 training_end_time = time.time()
+epochs_trained = len(train_loss_vals)
 
 print("Training took " + str(training_end_time - training_start_time) + " seconds")
+save_step_time(OUTPUT_DIR, train_epoch_times, train_epoch_steps)
 
-flow_model.save_pretrained(
-    OUTPUT_DIR + "model/" + TARGET_CORPUS + "-" + MODEL_CHECKPOINT + "-model"
-)
+# The model is written in the background while the plots and the final
+# evaluation run, early stopping already kept the best model on disk
+if not EARLY_STOPPING:
+    checkpoint_writer.save_model(accelerator.unwrap_model(flow_model), MODEL_DIR)
 
-plt.plot(range(1, epochs + 1), train_loss_vals, label="Training Loss")
-plt.plot(range(1, epochs + 1), eval_loss_vals, label="Validation Loss")
+plt.plot(range(1, epochs_trained + 1), train_loss_vals, label="Training Loss")
+plt.plot(range(1, epochs_trained + 1), eval_loss_vals, label="Validation Loss")
 
 plt.title("Loss for " + MODEL_CHECKPOINT + " Model with " + TARGET_CORPUS + " Dataset")
 plt.xlabel("Epochs")
-plt.xticks(range(1, epochs + 1), [int(i) for i in range(1, epochs + 1)])
+plt.xticks(range(1, epochs_trained + 1), [int(i) for i in range(1, epochs_trained + 1)])
 
 plt.ylabel("Loss")
 plt.ylim(0, None)
@@ -323,7 +723,7 @@ plt.savefig(OUTPUT_DIR + "train_valid_losses.png")
 
 plt.clf()
 for key in ["Macro Precision", "Macro Recall", "Macro F1"]:
-    plt.plot(range(1, epochs + 1), overall_metrics[key], label=key)
+    plt.plot(range(1, epochs_trained + 1), overall_metrics[key], label=key)
 
 plt.title(
     "Macro Metrics for "
@@ -333,7 +733,7 @@ plt.title(
     + " Dataset"
 )
 plt.xlabel("Epochs")
-plt.xticks(range(1, epochs + 1), [int(i) for i in range(1, epochs + 1)])
+plt.xticks(range(1, epochs_trained + 1), [int(i) for i in range(1, epochs_trained + 1)])
 
 plt.ylabel("Score")
 plt.ylim(None, 100)
@@ -343,11 +743,11 @@ plt.savefig(OUTPUT_DIR + "macro_metrics.png")
 
 plt.clf()
 for key in ["Macro F1", "Weighted F1"]:
-    plt.plot(range(1, epochs + 1), overall_metrics[key], label=key)
+    plt.plot(range(1, epochs_trained + 1), overall_metrics[key], label=key)
 
 plt.title("F1 for " + MODEL_CHECKPOINT + " Model with " + TARGET_CORPUS + " Dataset")
 plt.xlabel("Epochs")
-plt.xticks(range(1, epochs + 1), [int(i) for i in range(1, epochs + 1)])
+plt.xticks(range(1, epochs_trained + 1), [int(i) for i in range(1, epochs_trained + 1)])
 
 plt.ylabel("Score")
 plt.ylim(None, 100)
@@ -357,13 +757,13 @@ plt.savefig(OUTPUT_DIR + "f1_comparison.png")
 
 plt.clf()
 for key in ["Macro Edge F1", "Weighted Edge F1", "Non-Edge F1"]:
-    plt.plot(range(1, epochs + 1), overall_metrics[key], label=key)
+    plt.plot(range(1, epochs_trained + 1), overall_metrics[key], label=key)
 
 plt.title(
     "Edge Metrics for " + MODEL_CHECKPOINT + " Model with " + TARGET_CORPUS + " Dataset"
 )
 plt.xlabel("Epochs")
-plt.xticks(range(1, epochs + 1), [int(i) for i in range(1, epochs + 1)])
+plt.xticks(range(1, epochs_trained + 1), [int(i) for i in range(1, epochs_trained + 1)])
 
 plt.ylabel("Score")
 plt.ylim(None, 100)
@@ -371,6 +771,12 @@ plt.ylim(None, 100)
 plt.legend()
 plt.savefig(OUTPUT_DIR + "edge_metrics.png")
 
+if EARLY_STOPPING and early_stopping.best is not None:
+    # The final report is of the best model, as kept on disk
+    checkpoint_writer.wait()
+    accelerator.wait_for_everyone()
+    restore_best_model(accelerator.unwrap_model(flow_model), MODEL_DIR)
+
 _, _, pred_vals, true_vals = evaluate(eval_dl)
 
 labeled_preds = [label_names[pred_val] for pred_val in pred_vals]
@@ -380,3 +786,8 @@ report = classification_report(labeled_trues, labeled_preds, output_dict=True)
 
 df = pd.DataFrame(report).transpose()
 df.to_csv(OUTPUT_DIR + "classification_report.csv")
+
+if FAST:
+    compare_fast_run(FP32_OUTPUT_DIR, OUTPUT_DIR)
+
+checkpoint_writer.close()
@@ -7,8 +7,8 @@ Original file is located at
     https://colab.research.google.com/drive/10XyZkE4viWPaXKJG-utD7U6Er8PrIm9J
 """
 
-import glob
 import os
+import sys
 from pathlib import Path
 
 import pydot
@@ -29,14 +29,12 @@ os.environ["TOKENIZERS_PARALLELISM"] = "true"
 
 PROJECT_DIR = "/cluster/project2/COMP0029_17022125/NLP-FYP-HPC/"
 
-NER_FILES, FLOW_FILES = [], []
+sys.path.append(PROJECT_DIR)
 
-for corpus in ["r-100", "r-200"]:
-    NER_FILES += glob.glob(PROJECT_DIR + corpus + "/*.list")
-    FLOW_FILES += glob.glob(PROJECT_DIR + corpus + "/*.flow")
+from shared.corpus_loader import load_corpus
+from shared.relation_matrix import load_relation_matrix
 
-NER_FILES.sort()
-FLOW_FILES.sort()
+CORPUS = load_corpus(PROJECT_DIR, "r-300")
 
 ner_model = AutoModelForTokenClassification.from_pretrained(
     PROJECT_DIR + "saved-models/ner-model"
@@ -46,14 +44,10 @@ ner_tokenizer = AutoTokenizer.from_pretrained("bert-base-cased")
 ner_id2label = ner_model.config.id2label
 
 
-def split_into_sentences(ner_lines):
+def split_into_sentences(recipe):
     sentences, sentence, keys_list, keys = [], [], [], []
 
-    for line in ner_lines:
-        items = line.strip().split(" ")
-        position = (int(items[0]), int(items[1]), int(items[2]))
-        word, pos = items[3], items[4]
-
+    for position, word, pos, _ in recipe.tokens():
         sentence.append(word)
         keys.append(position)
 
@@ -100,15 +94,10 @@ def obtain_predicted_ner_tags(sentences, keys_list):
     return word_dict, ner_dict
 
 
-def obtain_true_ner_tags(ner_lines):
+def obtain_true_ner_tags(recipe):
     word_dict, ner_dict = {}, {}
 
-    for line in ner_lines:
-        items = line.strip().split(" ")
-
-        key = (int(items[0]), int(items[1]), int(items[2]))
-        word, ner_tag = items[3], items[5]
-
+    for key, word, _, ner_tag in recipe.tokens():
         word_dict[key] = word
         ner_dict[key] = ner_tag
 
@@ -124,24 +113,20 @@ flow_id2label = flow_model.config.id2label
 
 import pickle
 
-with open(PROJECT_DIR + "r-300-relation_set.pickle", "rb") as relation_set_file:
-    RELATION_SET = pickle.load(relation_set_file)
+RELATION_MATRIX = load_relation_matrix(PROJECT_DIR, "r-300")
 
 
 def construct_predicted_entity_pairs(ner_dict):
-    entity_pairs = []
-
     ner_keys = list(ner_dict.keys())
 
-    for i in range(len(ner_keys)):
-        for j in range(i + 1, len(ner_keys)):
-            pair1 = ner_dict[ner_keys[i]] + "->" + ner_dict[ner_keys[j]]
-            pair2 = ner_dict[ner_keys[j]] + "->" + ner_dict[ner_keys[i]]
-
-            if pair1 in RELATION_SET or pair2 in RELATION_SET:
-                entity_pairs.append((ner_keys[i], ner_keys[j]))
+    sources, dests, _ = RELATION_MATRIX.candidate_pairs(
+        [ner_dict[ner_key] for ner_key in ner_keys]
+    )
 
-    return entity_pairs
+    return [
+        (ner_keys[source], ner_keys[dest])
+        for source, dest in zip(sources.tolist(), dests.tolist())
+    ]
 
 
 def construct_sentence(word_dict, ner_dict, sentence_index, target_positions):
@@ -216,16 +201,10 @@ def tokenize_sentence_pair(first_sentence, second_sentence):
     )
 
 
-def construct_true_entity_pairs_with_labels(flow_lines):
+def construct_true_entity_pairs_with_labels(recipe):
     entity_pairs, labels = [], []
 
-    for line in flow_lines:
-        items = line.strip().split(" ")
-
-        source_key = (int(items[0]), int(items[1]), int(items[2]))
-        dest_key = (int(items[4]), int(items[5]), int(items[6]))
-        label = items[3]
-
+    for source_key, label, dest_key in recipe.flows():
         entity_pairs.append((source_key, dest_key))
         labels.append(label)
 
@@ -291,8 +270,8 @@ def obtain_true_flow_edges(ner_dict, phrase_dict, entity_pairs, labels):
     return edges
 
 
-def food_recipe_to_predicted_flow_graph(ner_lines):
-    sentences, keys_list = split_into_sentences(ner_lines)
+def food_recipe_to_predicted_flow_graph(recipe):
+    sentences, keys_list = split_into_sentences(recipe)
     word_dict, ner_dict = obtain_predicted_ner_tags(sentences, keys_list)
     entity_pairs = construct_predicted_entity_pairs(ner_dict)
     phrase_dict = construct_phrase_dict(word_dict, ner_dict)
@@ -310,9 +289,9 @@ def food_recipe_to_predicted_flow_graph(ner_lines):
     return nodes, edges
 
 
-def food_recipe_to_true_flow_graph(ner_lines, flow_lines):
-    word_dict, ner_dict = obtain_true_ner_tags(ner_lines)
-    entity_pairs, labels = construct_true_entity_pairs_with_labels(flow_lines)
+def food_recipe_to_true_flow_graph(recipe):
+    word_dict, ner_dict = obtain_true_ner_tags(recipe)
+    entity_pairs, labels = construct_true_entity_pairs_with_labels(recipe)
     phrase_dict = construct_phrase_dict(word_dict, ner_dict)
 
     edges = obtain_true_flow_edges(ner_dict, phrase_dict, entity_pairs, labels)
@@ -434,15 +413,8 @@ def generate_true_graph(nodes, edges, dest_folder):
     print("Wrote Predicted PNG")
 
 
-for ner_file, flow_file in tqdm(
-    zip(NER_FILES, FLOW_FILES), desc="Generating Flow Graphs"
-):
-    ner_data, flow_data = open(ner_file, "r", encoding="utf-8"), open(
-        flow_file, "r", encoding="utf-8"
-    )
-    ner_lines, flow_lines = ner_data.readlines(), flow_data.readlines()
-
-    filename_without_extension = Path(ner_file).stem
+for recipe in tqdm(CORPUS, desc="Generating Flow Graphs"):
+    filename_without_extension = Path(recipe.ner_file).stem
     dest_folder = (
         PROJECT_DIR
         + "outputs/generated_flow_graphs_r-300/"
@@ -453,10 +425,10 @@ for ner_file, flow_file in tqdm(
     if not os.path.exists(dest_folder):
         os.makedirs(dest_folder)
 
-    predicted_nodes, predicted_edges = food_recipe_to_predicted_flow_graph(ner_lines)
+    predicted_nodes, predicted_edges = food_recipe_to_predicted_flow_graph(recipe)
     print("Predicted: " + str(len(predicted_nodes)) + str(len(predicted_edges)))
 
-    true_nodes, true_edges = food_recipe_to_true_flow_graph(ner_lines, flow_lines)
+    true_nodes, true_edges = food_recipe_to_true_flow_graph(recipe)
     print("True: " + str(len(true_nodes)) + str(len(true_edges)))
 
     with open(dest_folder + "predicted_flow_graph.pkl", "wb") as pred_f:
@@ -465,8 +437,6 @@ for ner_file, flow_file in tqdm(
     with open(dest_folder + "true_flow_graph.pkl", "wb") as true_f:
         pickle.dump((true_nodes, true_edges), true_f)
 
-    ner_data.close()
-    flow_data.close()
     pred_f.close()
     true_f.close()
 
@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+"""Flow Training Sweep
+
+Runs a grid of flow training configurations, every strategy with every
+undersample factor, unweighted and weighted, one after the other in a single
+process. Each run executes the training loop script of its strategy with its
+own arguments. Imports, the tokenizer, the tokenized datasets and a pristine
+copy of the pretrained weights stay in memory from one run to the next, so
+that only the first run of the sweep pays for loading them.
+"""
+
+import argparse
+import gc
+import itertools
+import runpy
+import sys
+import time
+import traceback
+
+import torch
+from matplotlib import pyplot as plt
+
+PROJECT_DIR = "/cluster/project2/COMP0029_17022125/NLP-FYP-HPC/"
+
+sys.path.append(PROJECT_DIR)
+
+from shared.pretrained_cache import keep_pretrained_in_memory
+
+STRATEGIES = {
+    "D-I": "directional-input/directional_input_flow_graph_",
+    "D-L": "directional-label/directional_label_flow_graph_",
+    "E-M": "entity-marker/entity_marker_flow_graph_",
+    "T-M": "typed-entity-marker/typed_entity_marker_flow_graph_",
+}
+
+parser = argparse.ArgumentParser()
+parser.add_argument(
+    "--t", type=str, help="Recipe Corpus Target: can either be r-100, r-200, or r-300"
+)
+parser.add_argument(
+    "--strategies",
+    nargs="+",
+    choices=list(STRATEGIES),
+    default=["D-L", "E-M", "T-M"],
+    help="Flow Encoding Strategies to Train",
+)
+parser.add_argument(
+    "--us",
+    type=float,
+    nargs="+",
+    default=[0.9, 0.75, 0.5, 0.0],
+    help="Undersample Factors: values between 0.0 and 1.0",
+)
+parser.add_argument(
+    "--weighting",
+    choices=["unweighted", "weighted", "both"],
+    default="both",
+    help="Training Runs without, with or both without and with Weighted Loss",
+)
+parser.add_argument("--epochs", type=int, help="Number of Epochs")
+parser.add_argument(
+    "--process",
+    action="store_true",
+    help="Toggling Data Processing of Every Strategy and Undersample Factor",
+)
+
+# Any other arguments, such as --length-grouped, are passed on to every run
+args, run_args = parser.parse_known_args()
+
+TARGET_CORPUS = args.t
+WEIGHTINGS = {
+    "unweighted": [False],
+    "weighted": [True],
+    "both": [False, True],
+}[args.weighting]
+
+keep_pretrained_in_memory()
+
+
+def run_script(script, script_args):
+    sys.argv = [PROJECT_DIR + script] + script_args
+
+    try:
+        runpy.run_path(PROJECT_DIR + script, run_name="__main__")
+        return True
+    except Exception:
+        traceback.print_exc()
+        return False
+    finally:
+        # Release the models and figures of the run before the next one
+        plt.close("all")
+        gc.collect()
+
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+
+
+failed_runs = []
+sweep_start_time = time.time()
+
+for strategy, undersample_factor in itertools.product(args.strategies, args.us):
+    corpus_args = ["--t", TARGET_CORPUS, "--us", str(undersample_factor)]
+
+    if args.process:
+        print(
+            "Processing "
+            + strategy
+            + " with Undersample Factor "
+            + str(undersample_factor)
+        )
+
+        if not run_script(STRATEGIES[strategy] + "data_processing.py", corpus_args):
+            failed_runs.append((strategy, undersample_factor, "processing"))
+            continue
+
+    for weighted in WEIGHTINGS:
+        name = (
+            strategy
+            + " with Undersample Factor "
+            + str(undersample_factor)
+            + (", Weighted" if weighted else "")
+        )
+        print("Training " + name)
+
+        training_args = corpus_args + ["--epochs", str(args.epochs)]
+
+        if weighted:
+            training_args.append("--weighted")
+
+        run_start_time = time.time()
+
+        if run_script(
+            STRATEGIES[strategy] + "training_loop.py", training_args + run_args
+        ):
+            print(name + " took " + str(time.time() - run_start_time) + " seconds")
+        else:
+            failed_runs.append(
+                (strategy, undersample_factor, "weighted" if weighted else "unweighted")
+            )
+
+print("Sweep took " + str(time.time() - sweep_start_time) + " seconds")
+
+if failed_runs:
+    print("Failed Runs: " + str(failed_runs))
+    sys.exit(1)
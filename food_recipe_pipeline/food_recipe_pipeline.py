@@ -11,7 +11,7 @@ Original file is located at
 # %%capture
 # !pip install transformers[sentencepiece]
 
-import pickle
+import sys
 
 import networkx as nx
 import nltk
@@ -26,6 +26,10 @@ from transformers import (
 
 PROJECT_DIR = "/cluster/project2/COMP0029_17022125/NLP-FYP-HPC/"
 
+sys.path.append(PROJECT_DIR)
+
+from shared.relation_matrix import load_relation_matrix
+
 device = torch.device("cpu")
 
 if torch.cuda.is_available():
@@ -84,24 +88,20 @@ flow_tokenizer = tokenizer = BertTokenizer.from_pretrained(
 
 flow_id2label = flow_model.config.id2label
 
-with open(PROJECT_DIR + "r-300-relation_set.pickle", "rb") as relation_set_file:
-    RELATION_SET = pickle.load(relation_set_file)
+RELATION_MATRIX = load_relation_matrix(PROJECT_DIR, "r-300")
 
 
 def construct_entity_pairs(ner_dict):
-    entity_pairs = []
-
     ner_keys = list(ner_dict.keys())
 
-    for i in range(len(ner_keys)):
-        for j in range(i + 1, len(ner_keys)):
-            pair1 = ner_dict[ner_keys[i]] + "->" + ner_dict[ner_keys[j]]
-            pair2 = ner_dict[ner_keys[j]] + "->" + ner_dict[ner_keys[i]]
-
-            if pair1 in RELATION_SET or pair2 in RELATION_SET:
-                entity_pairs.append((ner_keys[i], ner_keys[j]))
+    sources, dests, _ = RELATION_MATRIX.candidate_pairs(
+        [ner_dict[ner_key] for ner_key in ner_keys]
+    )
 
-    return entity_pairs
+    return [
+        (ner_keys[source], ner_keys[dest])
+        for source, dest in zip(sources.tolist(), dests.tolist())
+    ]
 
 
 def construct_sentence(word_dict, ner_dict, sentence_index, target_positions):
@@ -15,90 +15,64 @@ import argparse
 import csv
 
 # Imports for Data Processing
-import glob
+import sys
 
-import pandas as pd
-from datasets import ClassLabel, Dataset, DatasetDict, Sequence
+from datasets import DatasetDict, load_from_disk
 
 PROJECT_DIR = "/cluster/project2/COMP0029_17022125/NLP-FYP-HPC/"
 SEED = 2023
 
+sys.path.append(PROJECT_DIR)
+
+from shared.corpus_loader import glob_ner_files, load_corpus
+from shared.manifest import save_manifest
+from shared.ner_dataset import build_ner_dataset, ner_manifest, recipe_order
+
 parser = argparse.ArgumentParser()
 parser.add_argument(
     "--t", type=str, help="Recipe Corpus Target: can either be r-100, r-200, or r-300"
 )
+parser.add_argument(
+    "--csv",
+    action="store_true",
+    help="Toggling Export of the Tokens to <corpus>-recipe-ner-data.csv",
+)
 
 args = parser.parse_args()
 
 TARGET_CORPUS = args.t
 print("Preprocessing " + TARGET_CORPUS + " Corpus")
 
-max_word_count = 0
-
-recipe_files = []
-
-if TARGET_CORPUS != "r-300":
-    recipe_files += glob.glob(PROJECT_DIR + TARGET_CORPUS + "/*.list")
-else:
-    recipe_files += glob.glob(PROJECT_DIR + "r-100/*.list")
-    recipe_files += glob.glob(PROJECT_DIR + "r-200/*.list")
-
-recipe_ner_data_csv = open(
-    PROJECT_DIR + TARGET_CORPUS + "-recipe-ner-data.csv", "w", encoding="utf-8"
-)
-writer = csv.writer(recipe_ner_data_csv)
+corpus = load_corpus(PROJECT_DIR, TARGET_CORPUS)
+ner_files = glob_ner_files(PROJECT_DIR, TARGET_CORPUS)
 
-header = ["Sentence Number", "Word", "POS", "Label"]
-writer.writerow(header)
 
-sentence_no = 1
+def export_csv():
+    recipe_ner_data_csv = open(
+        PROJECT_DIR + TARGET_CORPUS + "-recipe-ner-data.csv", "w", encoding="utf-8"
+    )
+    writer = csv.writer(recipe_ner_data_csv)
 
-for file in recipe_files:
-    word_count = 0
-    recipe_data = open(file, "r", encoding="utf-8")
-    lines = recipe_data.readlines()
+    header = ["Sentence Number", "Word", "POS", "Label"]
+    writer.writerow(header)
 
-    for line in lines:
-        items = line.split(" ")
-        word = items[3]
-        pos = items[4]
-        label = items[5].replace("\n", "")
-        word_count += 1
+    sentence_no = 1
 
-        row = ["Sentence_" + str(sentence_no), word, pos, label]
-        writer.writerow(row)
+    for index in recipe_order(corpus, ner_files):
+        for _, word, pos, label in corpus[index].tokens():
+            row = ["Sentence_" + str(sentence_no), word, pos, label]
+            writer.writerow(row)
 
-        if pos == ".":
-            sentence_no += 1
+            if pos == ".":
+                sentence_no += 1
 
-    max_word_count = max(word_count, max_word_count)
+    recipe_ner_data_csv.close()
 
-    recipe_data.close()
 
-recipe_ner_data_csv.close()
-max_word_count
-
-df = pd.read_csv(PROJECT_DIR + TARGET_CORPUS + "-recipe-ner-data.csv")
-pos_list = df["POS"].unique()
-label_list = sorted(df["Label"].unique())
-
-label_list.remove("O")
-label_list.append("O")
-
-grouped = (
-    df.groupby("Sentence Number")
-    .agg({"Word": list, "POS": list, "Label": list})
-    .reset_index()
-)
-grouped.drop("Sentence Number", axis=1, inplace=True)
-grouped.rename(
-    columns={"Word": "tokens", "POS": "pos", "Label": "ner_tags"}, inplace=True
-)
-
-dataset = Dataset.from_pandas(grouped)
-dataset = dataset.cast_column("pos", Sequence(ClassLabel(names=list(pos_list))))
-dataset = dataset.cast_column("ner_tags", Sequence(ClassLabel(names=list(label_list))))
+if args.csv:
+    export_csv()
 
+dataset = build_ner_dataset(corpus, ner_files)
 dataset = dataset.shuffle(seed=SEED)
 split_dataset = dataset.train_test_split(test_size=0.2)
 
@@ -106,4 +80,7 @@ corpus_datasets = DatasetDict(
     {"train": split_dataset["train"], "valid": split_dataset["test"]}
 )
 
-corpus_datasets.save_to_disk(PROJECT_DIR + "datasets/" + TARGET_CORPUS + "-ner")
+DATASET_DIR = PROJECT_DIR + "datasets/" + TARGET_CORPUS + "-ner"
+
+corpus_datasets.save_to_disk(DATASET_DIR)
+save_manifest(DATASET_DIR, ner_manifest(load_from_disk(DATASET_DIR)))
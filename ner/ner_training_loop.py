@@ -12,7 +12,9 @@ Original file is located at
 # !pip install datasets evaluate transformers[sentencepiece] seqeval accelerate
 
 import argparse
+import math
 import os
+import sys
 import time
 from collections import defaultdict
 
@@ -20,7 +22,7 @@ import evaluate
 import numpy as np
 import pandas as pd
 import torch
-from accelerate import Accelerator
+from accelerate import skip_first_batches
 from datasets import load_from_disk
 from matplotlib import pyplot as plt
 from seqeval.metrics import (
@@ -34,28 +36,123 @@ from torch.utils.data import DataLoader
 from tqdm.auto import tqdm
 from transformers import (
     AutoModelForTokenClassification,
-    AutoTokenizer,
     DataCollatorForTokenClassification,
     get_scheduler,
 )
 
 # REPLACE CONSTANTS AS APPROPRIATE
 PROJECT_DIR = "/cluster/project2/COMP0029_17022125/NLP-FYP-HPC/"
+SCRATCH_SPACE = "/home/sejipark/NLP-FYP-HPC/"
 MODEL_CHECKPOINT = "bert-base-cased"
+MAX_LENGTH = 128
+
+sys.path.append(PROJECT_DIR)
+
+from shared.batch_tuning import tune_batch_size
+from shared.checkpointing import (
+    CheckpointWriter,
+    load_checkpoint,
+    restore_training_state,
+    training_state,
+)
+from shared.fast_mode import (
+    compare_fast_run,
+    compile_forward,
+    fast_accelerator,
+    save_step_time,
+)
+from shared.length_grouping import (
+    LengthGroupedBatchSampler,
+    report_padding,
+    sequence_lengths,
+)
+from shared.manifest import load_manifest, report_manifest
+from shared.pretrained_cache import pretrained_model, pretrained_tokenizer
+from shared.sequence_packing import PackedCollator, PackedDataset, report_packing
+from shared.tensor_loading import tensor_dataloader, tokenizer_pad_values
+from shared.tokenization_cache import tokenize_datasets
 
 parser = argparse.ArgumentParser()
 parser.add_argument(
     "--t", type=str, help="Recipe Corpus Target: can either be r-100, r-200, or r-300"
 )
 parser.add_argument("--epochs", type=int, help="Number of Epochs")
+parser.add_argument(
+    "--length-grouped",
+    action="store_true",
+    help="Toggling Length-Grouped Batching with Dynamic Padding",
+)
+parser.add_argument(
+    "--mmap-loading",
+    action="store_true",
+    help="Toggling Batch Loading from Memory-Mapped Tensors",
+)
+parser.add_argument(
+    "--workers",
+    type=int,
+    default=2,
+    help="Number of DataLoader Worker Processes for Memory-Mapped Loading",
+)
+parser.add_argument(
+    "--fast",
+    action="store_true",
+    help="Toggling bf16 Autocast and a Compiled Model Forward",
+)
+parser.add_argument(
+    "--batch-size",
+    type=int,
+    default=32,
+    help="Number of Examples per Optimizer Step",
+)
+parser.add_argument(
+    "--auto-batch",
+    action="store_true",
+    help="Toggling the Micro-Batch Size Probe with Gradient Accumulation",
+)
+parser.add_argument(
+    "--packing",
+    action="store_true",
+    help="Toggling Packing of Several Training Sentences into Each Sequence",
+)
+parser.add_argument(
+    "--checkpoint-steps",
+    type=int,
+    default=0,
+    help="Number of Optimizer Steps between Checkpoints, 0 for No Checkpoints",
+)
+parser.add_argument(
+    "--resume",
+    action="store_true",
+    help="Toggling Resuming the Run from its Last Checkpoint",
+)
 
 args = parser.parse_args()
 
 TARGET_CORPUS = args.t
+LENGTH_GROUPED = args.length_grouped
+MMAP_LOADING = args.mmap_loading
+WORKERS = args.workers
+FAST = args.fast
+BATCH_SIZE = args.batch_size
+AUTO_BATCH = args.auto_batch
+PACKING = args.packing
+CHECKPOINT_STEPS = args.checkpoint_steps
+RESUME = args.resume
 print("Training with " + TARGET_CORPUS + " Corpus")
 
 OUTPUT_DIR = PROJECT_DIR + "outputs/ner/" + TARGET_CORPUS + "/" + MODEL_CHECKPOINT + "/"
 
+# Fast runs are saved next to the fp32 run they are compared against
+FP32_OUTPUT_DIR = OUTPUT_DIR
+
+if FAST:
+    OUTPUT_DIR = OUTPUT_DIR + "fast/"
+
+# Checkpoints of the run mirror its outputs
+CHECKPOINT_DIR = OUTPUT_DIR.replace(
+    PROJECT_DIR + "outputs/", SCRATCH_SPACE + "checkpoints/"
+)
+
 if not os.path.exists(OUTPUT_DIR):
     os.makedirs(OUTPUT_DIR)
 
@@ -64,7 +161,10 @@ device = torch.device("cpu")
 if torch.cuda.is_available():
     device = torch.device("cuda")
 
-corpus_datasets = load_from_disk(PROJECT_DIR + "datasets/" + TARGET_CORPUS + "-ner")
+DATASET_DIR = PROJECT_DIR + "datasets/" + TARGET_CORPUS + "-ner"
+
+corpus_datasets = load_from_disk(DATASET_DIR)
+report_manifest(load_manifest(DATASET_DIR))
 
 ner_feature = corpus_datasets["train"].features["ner_tags"]
 label_names = ner_feature.feature.names
@@ -72,7 +172,7 @@ pure_label_names = list(
     set(label.replace("-B", "").replace("-I", "") for label in label_names)
 )
 
-tokenizer = AutoTokenizer.from_pretrained(MODEL_CHECKPOINT)
+tokenizer = pretrained_tokenizer(MODEL_CHECKPOINT)
 tokenizer.save_pretrained(
     OUTPUT_DIR + "tokenizer/" + TARGET_CORPUS + "-" + MODEL_CHECKPOINT + "-tokenizer"
 )
@@ -95,7 +195,10 @@ def align_labels_with_tokens(labels, word_ids):
 
 def tokenize_and_align_labels(examples):
     tokenized_inputs = tokenizer(
-        examples["tokens"], truncation=True, is_split_into_words=True, max_length=128
+        examples["tokens"],
+        truncation=True,
+        is_split_into_words=True,
+        max_length=MAX_LENGTH,
     )
     all_labels = examples["ner_tags"]
     new_labels = []
@@ -107,30 +210,102 @@ def tokenize_and_align_labels(examples):
     return tokenized_inputs
 
 
-tokenized_datasets = corpus_datasets.map(
+tokenized_datasets = tokenize_datasets(
+    PROJECT_DIR + "cache/tokenized/",
+    "ner",
+    corpus_datasets,
+    tokenizer,
     tokenize_and_align_labels,
-    batched=True,
+    MAX_LENGTH,
+    False,
     remove_columns=corpus_datasets["train"].column_names,
 )
 
-data_collator = DataCollatorForTokenClassification(tokenizer=tokenizer)
+# Fast runs pad to a few fixed lengths, which the compiled forward is compiled
+# for once each
+data_collator = DataCollatorForTokenClassification(
+    tokenizer=tokenizer, pad_to_multiple_of=32 if FAST else None
+)
 
 id2label = {i: label for i, label in enumerate(label_names)}
 label2id = {v: k for k, v in id2label.items()}
 
-train_dataloader = DataLoader(
-    tokenized_datasets["train"],
-    collate_fn=data_collator,
-    batch_size=32,
-)
+accelerator = fast_accelerator(FAST)
+
+MICRO_BATCH_SIZE, ACCUMULATION_STEPS = BATCH_SIZE, 1
+
+if AUTO_BATCH:
+    MICRO_BATCH_SIZE, ACCUMULATION_STEPS = tune_batch_size(
+        AutoModelForTokenClassification,
+        MODEL_CHECKPOINT,
+        len(label_names),
+        BATCH_SIZE,
+        MAX_LENGTH,
+        tokenizer.vocab_size,
+        accelerator,
+        fast=FAST,
+        dynamic_shapes=MMAP_LOADING or PACKING or LENGTH_GROUPED,
+        token_labels=True,
+    )
 
-eval_dataloader = DataLoader(
-    tokenized_datasets["valid"],
-    collate_fn=data_collator,
-    batch_size=32,
-)
+if LENGTH_GROUPED:
+    train_sampler = LengthGroupedBatchSampler(
+        sequence_lengths(tokenized_datasets["train"]), batch_size=MICRO_BATCH_SIZE
+    )
+    eval_sampler = LengthGroupedBatchSampler(
+        sequence_lengths(tokenized_datasets["valid"]),
+        batch_size=MICRO_BATCH_SIZE,
+        shuffle=False,
+    )
+
+    report_padding("Train", train_sampler.lengths, train_sampler)
+    report_padding("Valid", eval_sampler.lengths, eval_sampler)
 
-ner_model = AutoModelForTokenClassification.from_pretrained(
+    train_batching = {"batch_sampler": train_sampler}
+    eval_batching = {"batch_sampler": eval_sampler}
+else:
+    train_batching = {"batch_size": MICRO_BATCH_SIZE}
+    eval_batching = {"batch_size": MICRO_BATCH_SIZE}
+
+if MMAP_LOADING:
+    pad_values = tokenizer_pad_values(tokenizer)
+
+    train_dataloader = tensor_dataloader(
+        tokenized_datasets["train"], pad_values, WORKERS, **train_batching
+    )
+    eval_dataloader = tensor_dataloader(
+        tokenized_datasets["valid"], pad_values, WORKERS, **eval_batching
+    )
+else:
+    train_dataloader = DataLoader(
+        tokenized_datasets["train"], collate_fn=data_collator, **train_batching
+    )
+    eval_dataloader = DataLoader(
+        tokenized_datasets["valid"], collate_fn=data_collator, **eval_batching
+    )
+
+# Only training is packed, the valid split is still evaluated sentence by
+# sentence
+if PACKING:
+    packed_dataset = PackedDataset(tokenized_datasets["train"], MAX_LENGTH)
+    report_packing("Train", packed_dataset, MAX_LENGTH)
+
+    # Batches keep about MICRO_BATCH_SIZE sentences, like the unpacked batches
+    packed_batch_size = max(
+        1,
+        round(
+            MICRO_BATCH_SIZE * len(packed_dataset) / len(tokenized_datasets["train"])
+        ),
+    )
+
+    train_dataloader = DataLoader(
+        packed_dataset,
+        batch_size=packed_batch_size,
+        collate_fn=PackedCollator(tokenizer),
+    )
+
+ner_model = pretrained_model(
+    AutoModelForTokenClassification,
     MODEL_CHECKPOINT,
     id2label=id2label,
     label2id=label2id,
@@ -153,14 +328,18 @@ optimizer_grouped_parameters = [
 
 optimizer = AdamW(optimizer_grouped_parameters, lr=3e-5, eps=1e-8)
 
-accelerator = Accelerator()
+if FAST:
+    ner_model = compile_forward(
+        ner_model, dynamic_shapes=MMAP_LOADING or PACKING or LENGTH_GROUPED
+    )
+
 ner_model, optimizer, train_dataloader, eval_dataloader = accelerator.prepare(
     ner_model, optimizer, train_dataloader, eval_dataloader
 )
 
 epochs = args.epochs
 print("Training with " + str(epochs) + " epochs")
-steps_per_epoch = len(train_dataloader)
+steps_per_epoch = math.ceil(len(train_dataloader) / ACCUMULATION_STEPS)
 num_training_steps = epochs * steps_per_epoch
 
 lr_scheduler = get_scheduler(
@@ -234,15 +413,70 @@ progress_bar = tqdm(range(num_training_steps))
 
 overall_metrics = defaultdict(list)
 train_loss_vals, eval_loss_vals = [], []
+train_epoch_times, train_epoch_steps = [], []
+
+checkpoint_writer = CheckpointWriter(CHECKPOINT_DIR, accelerator.is_main_process)
+start_epoch, resumed_step, resumed_loss_val, completed_steps = 0, 0, 0, 0
+
+
+def save_checkpoint(epoch, step, train_loss_val):
+    # step is the number of micro-batches of the epoch trained on so far
+    progress = {
+        "epoch": epoch,
+        "step": step,
+        "train_loss_val": train_loss_val,
+        "completed_steps": completed_steps,
+        "num_training_steps": num_training_steps,
+        "train_loss_vals": train_loss_vals,
+        "eval_loss_vals": eval_loss_vals,
+        "overall_metrics": dict(overall_metrics),
+        "train_epoch_times": train_epoch_times,
+        "train_epoch_steps": train_epoch_steps,
+    }
+
+    checkpoint_writer.save(
+        training_state(accelerator, ner_model, optimizer, lr_scheduler, progress)
+    )
+
+
+checkpoint = load_checkpoint(CHECKPOINT_DIR) if RESUME else None
+
+if checkpoint is not None:
+    progress = restore_training_state(
+        checkpoint, accelerator, ner_model, optimizer, lr_scheduler, num_training_steps
+    )
+
+    start_epoch, resumed_step = progress["epoch"], progress["step"]
+    resumed_loss_val = progress["train_loss_val"]
+    completed_steps = progress["completed_steps"]
+    train_loss_vals = progress["train_loss_vals"]
+    eval_loss_vals = progress["eval_loss_vals"]
+    overall_metrics.update(progress["overall_metrics"])
+    train_epoch_times = progress["train_epoch_times"]
+    train_epoch_steps = progress["train_epoch_steps"]
+
+    progress_bar.update(completed_steps)
+    del checkpoint
 
 training_start_time = time.time()
 
-for epoch in range(epochs):
-    # Training
-    train_loss_val = 0
+for epoch in range(start_epoch, epochs):
+    if LENGTH_GROUPED:
+        train_sampler.set_epoch(epoch)
+
+    # Training, a resumed epoch skips the batches it trained on before its
+    # checkpoint
+    first_step, train_loss_val = resumed_step, resumed_loss_val
+    resumed_step, resumed_loss_val = 0, 0
+    epoch_dataloader = train_dataloader
+
+    if first_step:
+        epoch_dataloader = skip_first_batches(train_dataloader, first_step)
 
     ner_model.train()
-    for batch in train_dataloader:
+    train_epoch_start_time = time.time()
+
+    for step, batch in enumerate(epoch_dataloader, start=first_step):
         labels = batch.get("labels")
 
         outputs = ner_model(**batch)
@@ -251,13 +485,31 @@ for epoch in range(epochs):
 
         train_loss_val += loss.item()
 
-        accelerator.backward(loss)
-
-        optimizer.step()
-        lr_scheduler.step()
-        optimizer.zero_grad()
-        progress_bar.update(1)
-
+        # The last accumulation group of the epoch may hold fewer
+        # micro-batches, which are averaged over their own number
+        group_start = step - step % ACCUMULATION_STEPS
+        group_size = min(ACCUMULATION_STEPS, len(train_dataloader) - group_start)
+        accelerator.backward(loss / group_size)
+
+        # Step once every ACCUMULATION_STEPS micro-batches and at the end of
+        # the epoch
+        if (step + 1) % ACCUMULATION_STEPS == 0 or step + 1 == len(train_dataloader):
+            optimizer.step()
+            lr_scheduler.step()
+            optimizer.zero_grad()
+            progress_bar.update(1)
+            completed_steps += 1
+
+            if (
+                CHECKPOINT_STEPS > 0
+                and completed_steps % CHECKPOINT_STEPS == 0
+                and step + 1 < len(train_dataloader)
+            ):
+                save_checkpoint(epoch, step + 1, train_loss_val)
+
+    train_epoch_times.append(time.time() - train_epoch_start_time)
+    # A resumed epoch only timed the micro-batches after its checkpoint
+    train_epoch_steps.append(step + 1 - first_step)
     train_loss_vals.append(train_loss_val / len(train_dataloader))
 
     # Evaluation
@@ -268,12 +520,26 @@ for epoch in range(epochs):
 
     eval_loss_vals.append(eval_loss_val)
 
+    # Checkpointing runs also checkpoint every epoch end
+    if CHECKPOINT_STEPS > 0:
+        save_checkpoint(epoch + 1, 0, 0)
+
 training_end_time = time.time()
 
 print("Training took " + str(training_end_time - training_start_time) + " seconds")
+save_step_time(OUTPUT_DIR, train_epoch_times, train_epoch_steps)
 
-ner_model.save_pretrained(
-    OUTPUT_DIR + "model/" + TARGET_CORPUS + "-" + MODEL_CHECKPOINT + "-model"
+train_tokens = int(sequence_lengths(tokenized_datasets["train"]).sum()) * epochs
+print(
+    "Train Tokens per Second: "
+    + str(train_tokens / (training_end_time - training_start_time))
+)
+
+# The model is written in the background while the plots and the final
+# evaluation run
+checkpoint_writer.save_model(
+    accelerator.unwrap_model(ner_model),
+    OUTPUT_DIR + "model/" + TARGET_CORPUS + "-" + MODEL_CHECKPOINT + "-model",
 )
 
 plt.plot(range(1, epochs + 1), train_loss_vals, label="Training Loss")
@@ -319,3 +585,8 @@ report = classification_report(true_labels, pred_labels, suffix=True, output_dic
 
 df = pd.DataFrame(report).transpose()
 df.to_csv(OUTPUT_DIR + "classification_report.csv")
+
+if FAST:
+    compare_fast_run(FP32_OUTPUT_DIR, OUTPUT_DIR)
+
+checkpoint_writer.close()
@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+"""Micro-Batch Tuning
+
+Probes the largest micro-batch of max-length sequences, up to the configured
+batch size, that a forward and backward pass fits into memory for, under the
+same bf16 autocast and compiled forward as training. The probe uses synthetic
+batches and binary search on every device type, and sets aside room for the
+AdamW state. The configured batch size is then reached with gradient
+accumulation, so every optimizer step, and with it the learning rate and the
+linear schedule, still sees the configured number of examples.
+"""
+
+import torch
+
+from shared.fast_mode import compile_forward
+
+
+def is_out_of_memory(error):
+    # CPU allocation failures are raised as plain RuntimeErrors
+    return isinstance(error, torch.cuda.OutOfMemoryError) or (
+        isinstance(error, RuntimeError) and "can't allocate memory" in str(error)
+    )
+
+
+def fits_in_memory(
+    model, accelerator, batch_size, max_length, vocab_size, token_labels
+):
+    device = next(model.parameters()).device
+    label_shape = (batch_size, max_length) if token_labels else (batch_size,)
+
+    try:
+        input_ids = torch.randint(vocab_size, (batch_size, max_length), device=device)
+
+        with accelerator.autocast():
+            outputs = model(
+                input_ids=input_ids,
+                attention_mask=torch.ones_like(input_ids),
+                labels=torch.zeros(label_shape, dtype=torch.long, device=device),
+            )
+
+        outputs.loss.backward()
+
+        return True
+    except (torch.cuda.OutOfMemoryError, RuntimeError) as error:
+        if not is_out_of_memory(error):
+            raise
+
+        return False
+    finally:
+        model.zero_grad(set_to_none=True)
+
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+
+
+def largest_micro_batch(
+    model, accelerator, max_batch_size, max_length, vocab_size, token_labels
+):
+    # Room for the two AdamW moments of every parameter, the gradients are
+    # allocated by the probes themselves
+    reserved = [
+        torch.empty_like(parameter)
+        for parameter in model.parameters()
+        for _ in range(2)
+    ]
+
+    low, high = 0, max_batch_size
+
+    while low < high:
+        batch_size = (low + high + 1) // 2
+
+        if fits_in_memory(
+            model, accelerator, batch_size, max_length, vocab_size, token_labels
+        ):
+            low = batch_size
+        else:
+            high = batch_size - 1
+
+    del reserved
+
+    return low
+
+
+def tune_batch_size(
+    model_class,
+    checkpoint,
+    num_labels,
+    batch_size,
+    max_length,
+    vocab_size,
+    accelerator,
+    fast=False,
+    dynamic_shapes=False,
+    token_labels=False,
+):
+    # Returns the micro-batch size and the number of accumulation steps that
+    # make up batches of batch_size
+    model = model_class.from_pretrained(checkpoint, num_labels=num_labels)
+    model.to(accelerator.device).train()
+
+    if fast:
+        model = compile_forward(model, dynamic_shapes=dynamic_shapes)
+
+    largest = largest_micro_batch(
+        model, accelerator, batch_size, max_length, vocab_size, token_labels
+    )
+
+    del model
+
+    if torch.cuda.is_available():
+        torch.cuda.empty_cache()
+
+    if largest == 0:
+        raise Exception("No Micro-Batch Fits in Memory")
+
+    # The micro-batch size has to divide the batch size for every optimizer
+    # step to see exactly batch_size examples
+    micro_batch_size = max(
+        size for size in range(1, largest + 1) if batch_size % size == 0
+    )
+    accumulation_steps = batch_size // micro_batch_size
+
+    print(
+        "Training on Micro-Batches of "
+        + str(micro_batch_size)
+        + " with "
+        + str(accumulation_steps)
+        + " Accumulation Steps per Batch of "
+        + str(batch_size)
+    )
+
+    return micro_batch_size, accumulation_steps
@@ -0,0 +1,188 @@
+# -*- coding: utf-8 -*-
+"""Training Checkpoints
+
+Periodically checkpoints the model, optimizer and lr_scheduler, the RNG states
+of every process and the progress of the run: the position in the training
+data along with the losses and metrics collected so far. A preempted job
+resumes from the last checkpoint, also in the middle of an epoch, since the
+batches of every epoch are a function of the epoch alone. The state is copied
+to CPU memory on the training thread and written to disk by a background
+thread, first to a temporary file that then atomically replaces the previous
+checkpoint, so a job killed while writing never leaves a partial checkpoint.
+"""
+
+import os
+import random
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import torch
+from accelerate.utils import gather_object
+
+CHECKPOINT_FILE = "checkpoint.pt"
+
+
+def cpu_copy(state):
+    if isinstance(state, torch.Tensor):
+        return state.detach().to("cpu", copy=True)
+
+    if isinstance(state, np.ndarray):
+        return state.copy()
+
+    if isinstance(state, dict):
+        return {key: cpu_copy(value) for key, value in state.items()}
+
+    if isinstance(state, (list, tuple)):
+        return type(state)(cpu_copy(value) for value in state)
+
+    return state
+
+
+def rng_states():
+    states = {
+        "python": random.getstate(),
+        "numpy": np.random.get_state(),
+        "torch": torch.get_rng_state(),
+    }
+
+    if torch.cuda.is_available():
+        states["cuda"] = torch.cuda.get_rng_state_all()
+
+    return states
+
+
+def set_rng_states(states):
+    random.setstate(states["python"])
+    np.random.set_state(states["numpy"])
+    torch.set_rng_state(states["torch"])
+
+    if "cuda" in states and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(states["cuda"])
+
+
+def training_state(accelerator, model, optimizer, lr_scheduler, progress):
+    # Has to be called on every process, each of which draws its own dropout
+    # masks
+    return {
+        "model": accelerator.unwrap_model(model).state_dict(),
+        "optimizer": optimizer.state_dict(),
+        "lr_scheduler": lr_scheduler.state_dict(),
+        "rng_states": gather_object([rng_states()]),
+        "progress": progress,
+    }
+
+
+def write_checkpoint(path, state):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temp_path = path + "." + str(os.getpid()) + ".tmp"
+
+    with open(temp_path, "wb") as file:
+        torch.save(state, file)
+        file.flush()
+        os.fsync(file.fileno())
+
+    os.replace(temp_path, path)
+
+
+def recover_model(model_dir):
+    # A job killed between the two renames of write_model left the previous
+    # model aside
+    model_dir = model_dir.rstrip("/")
+
+    if not os.path.exists(model_dir) and os.path.exists(model_dir + ".old"):
+        os.rename(model_dir + ".old", model_dir)
+
+
+def write_model(model, model_dir, state_dict):
+    # Replaces the model saved before, such as the previous best model, which
+    # is only deleted once the new model is in its place
+    model_dir = model_dir.rstrip("/")
+    temp_dir = model_dir + ".tmp"
+    old_dir = model_dir + ".old"
+
+    recover_model(model_dir)
+    shutil.rmtree(temp_dir, ignore_errors=True)
+    shutil.rmtree(old_dir, ignore_errors=True)
+
+    model.save_pretrained(temp_dir, state_dict=state_dict)
+
+    if os.path.exists(model_dir):
+        os.rename(model_dir, old_dir)
+
+    os.rename(temp_dir, model_dir)
+    shutil.rmtree(old_dir, ignore_errors=True)
+
+
+class CheckpointWriter:
+    def __init__(self, checkpoint_dir, is_main_process=True):
+        self.path = os.path.join(checkpoint_dir, CHECKPOINT_FILE)
+        self.is_main_process = is_main_process
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.pending = None
+
+    def wait(self):
+        # Raises any error of the last write on the training thread
+        if self.pending is not None:
+            self.pending.result()
+            self.pending = None
+
+    def submit(self, function, *args):
+        # Only the main process writes, and at most one copy of the state
+        # waits in memory to be written
+        if not self.is_main_process:
+            return
+
+        self.wait()
+        self.pending = self.executor.submit(function, *args)
+
+    def save(self, state):
+        self.submit(write_checkpoint, self.path, cpu_copy(state))
+
+    def save_model(self, model, model_dir):
+        self.submit(write_model, model, model_dir, cpu_copy(model.state_dict()))
+
+    def close(self):
+        self.wait()
+        self.executor.shutdown()
+
+
+def load_checkpoint(checkpoint_dir):
+    path = os.path.join(checkpoint_dir, CHECKPOINT_FILE)
+
+    if not os.path.exists(path):
+        print("No Checkpoint at " + checkpoint_dir + ", Training from the Start")
+        return None
+
+    print("Resuming from Checkpoint at " + checkpoint_dir)
+
+    return torch.load(path, map_location="cpu", weights_only=False)
+
+
+def restore_training_state(
+    checkpoint, accelerator, model, optimizer, lr_scheduler, num_training_steps
+):
+    progress = checkpoint["progress"]
+
+    if progress["num_training_steps"] != num_training_steps:
+        raise Exception(
+            "Checkpoint of "
+            + str(progress["num_training_steps"])
+            + " Training Steps Cannot Resume a Run of "
+            + str(num_training_steps)
+        )
+
+    if len(checkpoint["rng_states"]) != accelerator.num_processes:
+        raise Exception(
+            "Checkpoint of "
+            + str(len(checkpoint["rng_states"]))
+            + " Processes Cannot Resume with "
+            + str(accelerator.num_processes)
+        )
+
+    accelerator.unwrap_model(model).load_state_dict(checkpoint["model"])
+    optimizer.load_state_dict(checkpoint["optimizer"])
+    lr_scheduler.load_state_dict(checkpoint["lr_scheduler"])
+    set_rng_states(checkpoint["rng_states"][accelerator.process_index])
+
+    return progress
@@ -0,0 +1,418 @@
+# -*- coding: utf-8 -*-
+"""Shared Corpus Loader
+
+Parses the .list/.flow recipe annotations once into typed, array-backed tables
+and keeps them as a memory-mappable binary cache, so that re-running a script
+does not pay the text parsing cost again.
+"""
+
+import glob
+import hashlib
+import json
+import os
+import shutil
+
+import numpy as np
+
+from shared.positions import pack_positions
+
+CACHE_VERSION = 1
+
+TOKEN_COLUMNS = ["step", "sentence", "offset", "word_id", "pos_id", "tag_id"]
+FLOW_COLUMNS = [
+    "source_step",
+    "source_sentence",
+    "source_offset",
+    "label_id",
+    "dest_step",
+    "dest_sentence",
+    "dest_offset",
+]
+VOCABULARIES = ["words", "pos", "tags", "flow_labels"]
+
+
+def corpus_names(target_corpus):
+    if target_corpus == "r-100" or target_corpus == "r-200":
+        return [target_corpus]
+
+    if target_corpus == "r-300":
+        return ["r-100", "r-200"]
+
+    raise Exception("Could not recognize target corpus")
+
+
+def glob_ner_files(project_dir, target_corpus):
+    # The .list files in the unsorted order glob lists them in, which the NER
+    # dataset has always been built in
+    ner_files = []
+
+    for corpus in corpus_names(target_corpus):
+        ner_files += glob.glob(project_dir + corpus + "/*.list")
+
+    return ner_files
+
+
+def find_recipe_files(project_dir, target_corpus):
+    ner_files, flow_files = [], []
+
+    for corpus in corpus_names(target_corpus):
+        ner_files += glob.glob(project_dir + corpus + "/*.list")
+        flow_files += glob.glob(project_dir + corpus + "/*.flow")
+
+    ner_files.sort()
+    flow_files.sort()
+
+    if len(ner_files) != len(flow_files):
+        raise Exception("Mismatched Number of .list and .flow Files")
+
+    for ner_file, flow_file in zip(ner_files, flow_files):
+        if os.path.splitext(ner_file)[0] != os.path.splitext(flow_file)[0]:
+            raise Exception("No Matching .flow File for " + ner_file)
+
+    return ner_files, flow_files
+
+
+def hash_file(path):
+    digest = hashlib.sha256()
+
+    with open(path, "rb") as file:
+        for chunk in iter(lambda: file.read(1 << 20), b""):
+            digest.update(chunk)
+
+    return digest.hexdigest()
+
+
+def fingerprint_file(path, previous=None):
+    stat = os.stat(path)
+
+    # Only re-hash a file when its size or modification time has changed
+    if (
+        previous is not None
+        and previous["size"] == stat.st_size
+        and previous["mtime_ns"] == stat.st_mtime_ns
+    ):
+        sha256 = previous["sha256"]
+    else:
+        sha256 = hash_file(path)
+
+    return {
+        "path": path,
+        "size": stat.st_size,
+        "mtime_ns": stat.st_mtime_ns,
+        "sha256": sha256,
+    }
+
+
+def fingerprint_files(paths, previous_fingerprints=None):
+    previous = {}
+
+    if previous_fingerprints is not None:
+        previous = {
+            fingerprint["path"]: fingerprint for fingerprint in previous_fingerprints
+        }
+
+    return [fingerprint_file(path, previous.get(path)) for path in paths]
+
+
+def same_contents(fingerprints, other_fingerprints):
+    return [(f["path"], f["size"], f["sha256"]) for f in fingerprints] == [
+        (f["path"], f["size"], f["sha256"]) for f in other_fingerprints
+    ]
+
+
+def hash_contents(fingerprints):
+    contents = [
+        (fingerprint["path"], fingerprint["sha256"]) for fingerprint in fingerprints
+    ]
+
+    return hashlib.sha256(json.dumps(contents).encode("utf-8")).hexdigest()
+
+
+def lookup_id(vocabulary, index, value):
+    if value not in index:
+        index[value] = len(vocabulary)
+        vocabulary.append(value)
+
+    return index[value]
+
+
+def parse_corpus(ner_files, flow_files):
+    tokens = {column: [] for column in TOKEN_COLUMNS}
+    flows = {column: [] for column in FLOW_COLUMNS}
+    token_offsets, flow_offsets = [0], [0]
+
+    vocabularies = {name: [] for name in VOCABULARIES}
+    indices = {name: {} for name in VOCABULARIES}
+
+    for ner_file, flow_file in zip(ner_files, flow_files):
+        with open(ner_file, "r", encoding="utf-8") as ner_data:
+            for line in ner_data:
+                items = line.strip().split(" ")
+
+                tokens["step"].append(int(items[0]))
+                tokens["sentence"].append(int(items[1]))
+                tokens["offset"].append(int(items[2]))
+                tokens["word_id"].append(
+                    lookup_id(vocabularies["words"], indices["words"], items[3])
+                )
+                tokens["pos_id"].append(
+                    lookup_id(vocabularies["pos"], indices["pos"], items[4])
+                )
+                tokens["tag_id"].append(
+                    lookup_id(vocabularies["tags"], indices["tags"], items[5])
+                )
+
+        with open(flow_file, "r", encoding="utf-8") as flow_data:
+            for line in flow_data:
+                items = line.strip().split(" ")
+
+                flows["source_step"].append(int(items[0]))
+                flows["source_sentence"].append(int(items[1]))
+                flows["source_offset"].append(int(items[2]))
+                flows["label_id"].append(
+                    lookup_id(
+                        vocabularies["flow_labels"], indices["flow_labels"], items[3]
+                    )
+                )
+                flows["dest_step"].append(int(items[4]))
+                flows["dest_sentence"].append(int(items[5]))
+                flows["dest_offset"].append(int(items[6]))
+
+        token_offsets.append(len(tokens["step"]))
+        flow_offsets.append(len(flows["source_step"]))
+
+    tables = {}
+
+    for column, values in list(tokens.items()) + list(flows.items()):
+        tables[column] = np.array(values, dtype=np.int32)
+
+    tables["token_offsets"] = np.array(token_offsets, dtype=np.int64)
+    tables["flow_offsets"] = np.array(flow_offsets, dtype=np.int64)
+
+    return tables, vocabularies
+
+
+def read_manifest(cache_dir):
+    manifest_path = os.path.join(cache_dir, "manifest.json")
+
+    if not os.path.exists(manifest_path):
+        return None
+
+    with open(manifest_path, "r", encoding="utf-8") as manifest_file:
+        manifest = json.load(manifest_file)
+
+    if manifest.get("version") != CACHE_VERSION:
+        return None
+
+    return manifest
+
+
+def write_manifest(cache_dir, manifest):
+    temp_path = os.path.join(cache_dir, "manifest.json." + str(os.getpid()))
+
+    with open(temp_path, "w", encoding="utf-8") as manifest_file:
+        json.dump(manifest, manifest_file)
+
+    os.replace(temp_path, os.path.join(cache_dir, "manifest.json"))
+
+
+def build_cache(cache_dir, ner_files, flow_files, fingerprints):
+    tables, vocabularies = parse_corpus(ner_files, flow_files)
+
+    # Write into a private directory first so that concurrent jobs never see a
+    # half-written cache, then swap it into place
+    temp_dir = cache_dir.rstrip("/") + "." + str(os.getpid()) + ".tmp"
+    shutil.rmtree(temp_dir, ignore_errors=True)
+    os.makedirs(temp_dir)
+
+    for name, table in tables.items():
+        np.save(os.path.join(temp_dir, name + ".npy"), table)
+
+    write_manifest(
+        temp_dir,
+        {
+            "version": CACHE_VERSION,
+            "ner_files": ner_files,
+            "flow_files": flow_files,
+            "fingerprints": fingerprints,
+            "vocabularies": vocabularies,
+        },
+    )
+
+    shutil.rmtree(cache_dir, ignore_errors=True)
+
+    try:
+        os.rename(temp_dir, cache_dir.rstrip("/"))
+    except OSError:
+        # Another job published an identical cache in the meantime
+        shutil.rmtree(temp_dir, ignore_errors=True)
+
+
+def load_corpus(project_dir, target_corpus):
+    ner_files, flow_files = find_recipe_files(project_dir, target_corpus)
+    cache_dir = project_dir + "cache/corpus/" + target_corpus + "/"
+
+    manifest = read_manifest(cache_dir)
+    previous_fingerprints = None if manifest is None else manifest["fingerprints"]
+    fingerprints = fingerprint_files(ner_files + flow_files, previous_fingerprints)
+
+    if manifest is None or not same_contents(fingerprints, previous_fingerprints):
+        print("Building Corpus Cache for " + target_corpus)
+        os.makedirs(os.path.dirname(cache_dir.rstrip("/")), exist_ok=True)
+        build_cache(cache_dir, ner_files, flow_files, fingerprints)
+    elif fingerprints != previous_fingerprints:
+        # Files were touched without changing, remember the new modification times
+        manifest["fingerprints"] = fingerprints
+        write_manifest(cache_dir, manifest)
+
+    return RecipeCorpus(cache_dir)
+
+
+class RecipeCorpus:
+    def __init__(self, cache_dir):
+        manifest = read_manifest(cache_dir)
+
+        if manifest is None:
+            raise Exception("No Corpus Cache Found at " + cache_dir)
+
+        self.cache_dir = cache_dir
+        self.ner_files = manifest["ner_files"]
+        self.flow_files = manifest["flow_files"]
+        self.fingerprints = manifest["fingerprints"]
+        self.content_hash = hash_contents(self.fingerprints)
+
+        vocabularies = manifest["vocabularies"]
+        self.words = vocabularies["words"]
+        self.pos = vocabularies["pos"]
+        self.tags = vocabularies["tags"]
+        self.flow_labels = vocabularies["flow_labels"]
+
+        self.tables = {}
+
+        for name in TOKEN_COLUMNS + FLOW_COLUMNS + ["token_offsets", "flow_offsets"]:
+            self.tables[name] = np.load(
+                os.path.join(cache_dir, name + ".npy"), mmap_mode="r"
+            )
+
+    def __len__(self):
+        return len(self.ner_files)
+
+    def __getitem__(self, index):
+        return Recipe(self, index)
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield Recipe(self, index)
+
+
+class Recipe:
+    def __init__(self, corpus, index):
+        self.corpus = corpus
+        self.index = index
+        self.ner_file = corpus.ner_files[index]
+        self.flow_file = corpus.flow_files[index]
+        self.decoded_tokens = None
+        self.decoded_keyed_tokens = None
+
+        token_start, token_end = corpus.tables["token_offsets"][index : index + 2]
+        flow_start, flow_end = corpus.tables["flow_offsets"][index : index + 2]
+
+        self.token_table = {
+            column: corpus.tables[column][token_start:token_end]
+            for column in TOKEN_COLUMNS
+        }
+        self.flow_table = {
+            column: corpus.tables[column][flow_start:flow_end]
+            for column in FLOW_COLUMNS
+        }
+
+    def __len__(self):
+        return len(self.token_table["step"])
+
+    def positions(self):
+        return list(
+            zip(
+                self.token_table["step"].tolist(),
+                self.token_table["sentence"].tolist(),
+                self.token_table["offset"].tolist(),
+            )
+        )
+
+    def tokens(self):
+        # Decoded once per recipe, since sentence construction walks the
+        # tokens again for every candidate pair
+        if self.decoded_tokens is None:
+            words, pos, tags = self.corpus.words, self.corpus.pos, self.corpus.tags
+
+            self.decoded_tokens = [
+                (position, words[word_id], pos[pos_id], tags[tag_id])
+                for position, word_id, pos_id, tag_id in zip(
+                    self.positions(),
+                    self.token_table["word_id"].tolist(),
+                    self.token_table["pos_id"].tolist(),
+                    self.token_table["tag_id"].tolist(),
+                )
+            ]
+
+        return self.decoded_tokens
+
+    def keys(self):
+        return pack_positions(
+            self.token_table["step"],
+            self.token_table["sentence"],
+            self.token_table["offset"],
+        )
+
+    def keyed_tokens(self):
+        # Same as tokens(), but with positions packed into int64 keys
+        if self.decoded_keyed_tokens is None:
+            words, pos, tags = self.corpus.words, self.corpus.pos, self.corpus.tags
+
+            self.decoded_keyed_tokens = [
+                (key, words[word_id], pos[pos_id], tags[tag_id])
+                for key, word_id, pos_id, tag_id in zip(
+                    self.keys().tolist(),
+                    self.token_table["word_id"].tolist(),
+                    self.token_table["pos_id"].tolist(),
+                    self.token_table["tag_id"].tolist(),
+                )
+            ]
+
+        return self.decoded_keyed_tokens
+
+    def keyed_flows(self):
+        flow_labels = self.corpus.flow_labels
+        table = self.flow_table
+
+        source_keys = pack_positions(
+            table["source_step"], table["source_sentence"], table["source_offset"]
+        )
+        dest_keys = pack_positions(
+            table["dest_step"], table["dest_sentence"], table["dest_offset"]
+        )
+
+        return [
+            (source_key, flow_labels[label_id], dest_key)
+            for source_key, label_id, dest_key in zip(
+                source_keys.tolist(), table["label_id"].tolist(), dest_keys.tolist()
+            )
+        ]
+
+    def flows(self):
+        flow_labels = self.corpus.flow_labels
+        table = self.flow_table
+
+        for (
+            source_step,
+            source_sentence,
+            source_offset,
+            label_id,
+            dest_step,
+            dest_sentence,
+            dest_offset,
+        ) in zip(*[table[column].tolist() for column in FLOW_COLUMNS]):
+            yield (
+                (source_step, source_sentence, source_offset),
+                flow_labels[label_id],
+                (dest_step, dest_sentence, dest_offset),
+            )
@@ -0,0 +1,205 @@
+# -*- coding: utf-8 -*-
+"""Undersampled Index Views
+
+The full, un-undersampled pair table of an encoding strategy is saved once.
+Every undersample factor is then stored as a small view holding the label
+names and the rows of the full table that make up its train and valid splits,
+and is only materialized into a DatasetDict when a training loop loads it.
+"""
+
+import hashlib
+import json
+import os
+import shutil
+
+import numpy as np
+import pyarrow as pa
+from datasets import ClassLabel, Dataset, DatasetDict, DatasetInfo, load_from_disk
+
+from shared.manifest import save_manifest, split_summary
+from shared.pair_tables import pair_word_lengths
+
+VIEW_VERSION = 1
+
+
+def build_key(shard_cache):
+    return hashlib.sha256(json.dumps(shard_cache.keys).encode("utf-8")).hexdigest()
+
+
+def replace_dir(temp_dir, target_dir):
+    shutil.rmtree(target_dir, ignore_errors=True)
+    os.rename(temp_dir, target_dir)
+
+
+def read_build_info(dataset_dir):
+    build_info_path = os.path.join(dataset_dir, "build.json")
+
+    if not os.path.exists(build_info_path):
+        return None
+
+    with open(build_info_path, "r", encoding="utf-8") as build_info_file:
+        return json.load(build_info_file)
+
+
+def load_full_dataset(dataset_dir, key):
+    # Returns the saved full table and its counters, if it was built from
+    # exactly the current recipe shards
+    build_info = read_build_info(dataset_dir)
+
+    if build_info is None or build_info["build_key"] != key:
+        return None, None
+
+    return load_from_disk(dataset_dir), build_info["counts"]
+
+
+def save_full_dataset(
+    dataset, dataset_dir, key, counts, sentences=None, label_names=None
+):
+    temp_dir = dataset_dir + "." + str(os.getpid()) + ".tmp"
+    shutil.rmtree(temp_dir, ignore_errors=True)
+
+    dataset.save_to_disk(temp_dir)
+
+    # Pair tables keep the sentences they refer to next to them
+    if sentences is not None:
+        sentences.save_to_disk(os.path.join(temp_dir, "sentences"))
+
+    with open(os.path.join(temp_dir, "build.json"), "w", encoding="utf-8") as file:
+        json.dump(
+            {"build_key": key, "counts": counts, "label_names": label_names}, file
+        )
+
+    replace_dir(temp_dir, dataset_dir)
+
+    return load_from_disk(dataset_dir)
+
+
+def label_codes(dataset, build_info):
+    # Returns the distinct labels of the full table and the index of every
+    # row's label among them. Pair tables already store their labels as codes
+    # into the label names of their build info
+    if build_info.get("label_names") is not None:
+        return (
+            np.array(build_info["label_names"]),
+            dataset.data.column("Label").to_numpy(),
+        )
+
+    labels, inverse = np.unique(
+        dataset.data.column("Label").to_numpy(), return_inverse=True
+    )
+
+    return labels, inverse.reshape(-1)
+
+
+def full_dataset_labels(dataset, dataset_dir):
+    labels, codes = label_codes(dataset, read_build_info(dataset_dir))
+
+    return labels[codes]
+
+
+def view_manifest(dataset_dir, label_names, split_rows):
+    build_info = read_build_info(dataset_dir)
+    dataset = load_from_disk(dataset_dir)
+
+    label_ids = {name: label_id for label_id, name in enumerate(label_names)}
+    labels, codes = label_codes(dataset, build_info)
+    ids = np.array([label_ids.get(label, -1) for label in labels])[codes]
+
+    word_lengths = pair_word_lengths(
+        dataset, load_from_disk(os.path.join(dataset_dir, "sentences"))
+    )
+    included_count, rejected_count, edge_count = build_info["counts"]
+
+    return {
+        "counts": {
+            "included": included_count,
+            "rejected": rejected_count,
+            "edges": edge_count,
+        },
+        "label_names": list(label_names),
+        "splits": {
+            split: split_summary(
+                ids[np.asarray(rows)], len(label_names), word_lengths[np.asarray(rows)]
+            )
+            for split, rows in split_rows.items()
+        },
+    }
+
+
+def save_index_view(view_dir, dataset_dir, label_names, split_rows):
+    temp_dir = view_dir + "." + str(os.getpid()) + ".tmp"
+    shutil.rmtree(temp_dir, ignore_errors=True)
+    os.makedirs(temp_dir)
+
+    for split, rows in split_rows.items():
+        np.save(os.path.join(temp_dir, split + ".npy"), np.asarray(rows, np.int64))
+
+    with open(os.path.join(temp_dir, "view.json"), "w", encoding="utf-8") as file:
+        json.dump(
+            {
+                "version": VIEW_VERSION,
+                "dataset_dir": dataset_dir,
+                "build_key": read_build_info(dataset_dir)["build_key"],
+                "label_names": list(label_names),
+                "splits": list(split_rows),
+            },
+            file,
+        )
+
+    save_manifest(temp_dir, view_manifest(dataset_dir, label_names, split_rows))
+
+    replace_dir(temp_dir, view_dir)
+
+
+def load_index_view(view_dir):
+    view_path = os.path.join(view_dir, "view.json")
+
+    # Datasets saved before index views, manifests and sentence tables were
+    # introduced cannot be trained on anyway
+    if not os.path.exists(view_path):
+        raise Exception(
+            "Missing Index View at " + view_dir + ", Re-Run Data Processing"
+        )
+
+    with open(view_path, "r", encoding="utf-8") as view_file:
+        view = json.load(view_file)
+
+    if view["version"] != VIEW_VERSION:
+        raise Exception("Unsupported Index View Version at " + view_dir)
+
+    build_info = read_build_info(view["dataset_dir"])
+
+    if build_info is None or build_info["build_key"] != view["build_key"]:
+        raise Exception(
+            "Full Dataset Was Rebuilt Since "
+            + view_dir
+            + " Was Saved, Re-Run Data Processing"
+        )
+
+    dataset = load_from_disk(view["dataset_dir"])
+
+    # Swap the string labels for class ids once on the full table, so that the
+    # splits stay plain index selections over the memory-mapped rows
+    label_ids = {name: label_id for label_id, name in enumerate(view["label_names"])}
+    labels, codes = label_codes(dataset, build_info)
+    ids = np.array([label_ids.get(label, -1) for label in labels], dtype=np.int64)
+
+    features = dataset.features.copy()
+    features["Label"] = ClassLabel(names=view["label_names"])
+    table = dataset.data.remove_column(
+        dataset.column_names.index("Label")
+    ).append_column("Label", pa.array(ids[codes]))
+    dataset = Dataset(
+        table,
+        info=DatasetInfo(features=features),
+        fingerprint=hashlib.sha256(
+            json.dumps([view["build_key"], view["label_names"]]).encode("utf-8")
+        ).hexdigest()[:16],
+    )
+
+    return DatasetDict(
+        {
+            split: dataset.select(np.load(os.path.join(view_dir, split + ".npy")))
+            for split in view["splits"]
+        }
+    )
@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+"""Early Stopping
+
+Stops a flow run once a monitored validation metric, such as the macro or
+weighted edge F1, has not improved by more than min_delta for patience
+evaluations in a row. Evaluations are either the full evaluations at the end
+of every epoch or, every N optimizer steps, evaluations of a fixed subsample
+of the valid split, which keep the metric comparable from one to the next.
+Only the best model so far is kept on disk.
+"""
+
+import numpy as np
+
+from shared.checkpointing import recover_model
+
+MONITORED_METRICS = {
+    "macro-edge-f1": "Macro Edge F1",
+    "weighted-edge-f1": "Weighted Edge F1",
+}
+
+
+class EarlyStopping:
+    def __init__(self, patience, min_delta=0.0):
+        self.patience = patience
+        self.min_delta = min_delta
+        self.best = None
+        self.num_bad_evaluations = 0
+
+    @property
+    def stopped(self):
+        return self.num_bad_evaluations >= self.patience
+
+    def update(self, value):
+        # Returns whether the value is the new best
+        if self.best is None or value > self.best + self.min_delta:
+            self.best = value
+            self.num_bad_evaluations = 0
+            return True
+
+        self.num_bad_evaluations += 1
+
+        return False
+
+    def state_dict(self):
+        return {"best": self.best, "num_bad_evaluations": self.num_bad_evaluations}
+
+    def load_state_dict(self, state):
+        self.best = state["best"]
+        self.num_bad_evaluations = state["num_bad_evaluations"]
+
+
+def fixed_subsample(indices, size, seed=0):
+    indices = np.asarray(indices)
+
+    if size >= len(indices):
+        return np.sort(indices)
+
+    rng = np.random.default_rng(seed)
+
+    return np.sort(rng.choice(indices, size=size, replace=False))
+
+
+def restore_best_model(model, model_dir):
+    recover_model(model_dir)
+    best_model = type(model).from_pretrained(model_dir)
+    model.load_state_dict(best_model.state_dict())
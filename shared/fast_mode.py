@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+"""Fast Training Mode
+
+Opt-in bf16 autocast through Accelerate, which also covers CPU-only nodes,
+and a model forward compiled with torch.compile. Errors while compiling, also
+for batches of new shapes later on, fall back to running the forward eagerly.
+A fast run is checked against the classification report and the step time of
+the fp32 run saved next to it.
+"""
+
+import json
+import os
+
+import pandas as pd
+from accelerate import Accelerator
+
+
+def fast_accelerator(fast):
+    if not fast:
+        return Accelerator()
+
+    return Accelerator(mixed_precision="bf16")
+
+
+def compile_forward(model, dynamic_shapes=False):
+    # Only the forward is compiled, so the model itself is still the module
+    # that is saved and unwrapped. Batches of changing shapes would recompile
+    # it over and over, so they keep running eagerly
+    if dynamic_shapes:
+        print("Dynamic Batch Shapes, Running Eager")
+        return model
+
+    try:
+        import torch._dynamo
+
+        torch._dynamo.config.suppress_errors = True
+        model.forward = torch.compile(model.forward)
+    except (AttributeError, ImportError, RuntimeError) as error:
+        print("Compilation Unavailable, Running Eager: " + str(error))
+
+    return model
+
+
+def save_step_time(output_dir, epoch_times, epoch_steps):
+    # epoch_steps holds the number of micro-batches each timed epoch ran
+    if len(epoch_times) == 0:
+        return
+
+    # The last epoch leaves out the compilation of the first steps
+    seconds_per_step = epoch_times[-1] / max(epoch_steps[-1], 1)
+    print("Seconds per Train Step: " + str(seconds_per_step))
+
+    with open(
+        os.path.join(output_dir, "step_time.json"), "w", encoding="utf-8"
+    ) as file:
+        json.dump({"seconds_per_step": seconds_per_step}, file)
+
+
+def compare_fast_run(fp32_dir, fast_dir, tolerance=0.02):
+    fp32_report_path = os.path.join(fp32_dir, "classification_report.csv")
+
+    if not os.path.exists(fp32_report_path):
+        print("No fp32 Run at " + fp32_dir + " to Compare the Fast Run Against")
+        return
+
+    fp32_report = pd.read_csv(fp32_report_path, index_col=0)
+    fast_report = pd.read_csv(
+        os.path.join(fast_dir, "classification_report.csv"), index_col=0
+    )
+
+    metrics = ["precision", "recall", "f1-score"]
+    rows = fp32_report.index.intersection(fast_report.index)
+    differences = (
+        fast_report.loc[rows, metrics] - fp32_report.loc[rows, metrics]
+    ).abs()
+    exceeded = differences[(differences > tolerance).any(axis=1)]
+
+    print(
+        "Largest Metric Difference to fp32: "
+        + str(differences.max().max())
+        + ", "
+        + str(len(exceeded))
+        + " of "
+        + str(len(rows))
+        + " Rows beyond "
+        + str(tolerance)
+    )
+
+    if len(exceeded) > 0:
+        print(exceeded)
+
+    step_times = []
+
+    for output_dir in [fp32_dir, fast_dir]:
+        step_time_path = os.path.join(output_dir, "step_time.json")
+
+        if os.path.exists(step_time_path):
+            with open(step_time_path, "r", encoding="utf-8") as file:
+                step_times.append(json.load(file)["seconds_per_step"])
+
+    if len(step_times) == 2:
+        print("Step Time Speedup over fp32: " + str(step_times[0] / step_times[1]))
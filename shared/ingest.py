@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+"""Single-Pass Corpus Ingestion
+
+Turns every recipe of a corpus into the word, NER and flow lookups used by the
+flow data processing scripts exactly once, and derives the relation set from
+that same parse. The result is kept next to the corpus cache, so building the
+four encoding strategies back to back only ingests the corpus once.
+"""
+
+import os
+import pickle
+
+from shared.positions import sentence_of
+
+INGEST_VERSION = 4
+
+
+class ParsedRecipe:
+    def __init__(self, recipe):
+        self.index = recipe.index
+        self.ner_file = recipe.ner_file
+        self.flow_file = recipe.flow_file
+
+        self.tokens = recipe.keyed_tokens()
+        self.flows = recipe.keyed_flows()
+
+        self.word_dict = {key: word for key, word, _, _ in self.tokens}
+        self.ner_dict = {key: ner_tag for key, _, _, ner_tag in self.tokens}
+        self.sentence_slices = index_sentences(self.tokens)
+        self.entity_spans = index_entity_spans(self.tokens, self.sentence_slices)
+
+
+def index_sentences(tokens):
+    # Maps each packed (step, sentence) prefix to its slice of the token list,
+    # relying on the tokens of a sentence being contiguous in the .list file
+    sentence_slices = {}
+
+    for index, (key, _, _, _) in enumerate(tokens):
+        sentence = sentence_of(key)
+
+        if sentence not in sentence_slices:
+            sentence_slices[sentence] = (index, index + 1)
+        elif sentence_slices[sentence][1] == index:
+            sentence_slices[sentence] = (sentence_slices[sentence][0], index + 1)
+        else:
+            raise Exception("Tokens of a Sentence Are Not Contiguous")
+
+    return sentence_slices
+
+
+def index_entity_spans(tokens, sentence_slices):
+    # Maps the key of every entity-starting token to the (start, end) word
+    # offsets of its entity within its sentence, the entity running on for as
+    # long as the following tokens carry the matching -I tag
+    entity_spans = {}
+
+    for sentence_start, sentence_end in sentence_slices.values():
+        ner_tags = [ner_tag for _, _, _, ner_tag in tokens[sentence_start:sentence_end]]
+
+        for start, ner_tag in enumerate(ner_tags):
+            if "-I" in ner_tag or ner_tag == "O":
+                continue
+
+            end = start + 1
+            inside_tag = ner_tag.replace("-B", "-I")
+
+            while end < len(ner_tags) and ner_tags[end] == inside_tag:
+                end += 1
+
+            entity_spans[tokens[sentence_start + start][0]] = (start, end)
+
+    return entity_spans
+
+
+def construct_relation_set(recipes):
+    relation_set = set()
+
+    for recipe in recipes:
+        for source_key, _, dest_key in recipe.flows:
+            relation_set.add(
+                recipe.ner_dict[source_key] + "->" + recipe.ner_dict[dest_key]
+            )
+
+    return relation_set
+
+
+def ingest_corpus(corpus):
+    ingest_path = os.path.join(corpus.cache_dir, "ingest.pickle")
+
+    if os.path.exists(ingest_path):
+        with open(ingest_path, "rb") as ingest_file:
+            ingested = pickle.load(ingest_file)
+
+        if (
+            ingested["version"] == INGEST_VERSION
+            and ingested["content_hash"] == corpus.content_hash
+        ):
+            return ingested["recipes"], ingested["relation_set"]
+
+    recipes = [ParsedRecipe(recipe) for recipe in corpus]
+    relation_set = construct_relation_set(recipes)
+
+    temp_path = ingest_path + "." + str(os.getpid())
+
+    with open(temp_path, "wb") as ingest_file:
+        pickle.dump(
+            {
+                "version": INGEST_VERSION,
+                "content_hash": corpus.content_hash,
+                "recipes": recipes,
+                "relation_set": relation_set,
+            },
+            ingest_file,
+            protocol=pickle.HIGHEST_PROTOCOL,
+        )
+
+    os.replace(temp_path, ingest_path)
+
+    return recipes, relation_set
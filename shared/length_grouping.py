@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+"""Length-Grouped Batching
+
+Groups examples of similar token length into the same batch, so that padding
+each batch only up to its own longest sequence leaves very little padding.
+Training batches are shuffled within buckets of nearby examples and the order
+of the batches is shuffled again every epoch. With an index sampler, batches
+are only formed from the examples the sampler draws for the epoch.
+"""
+
+import numpy as np
+import pyarrow.compute as pc
+from torch.utils.data import Sampler
+
+
+def sequence_lengths(dataset, column="input_ids"):
+    if dataset._indices is not None:
+        return np.array([len(sequence) for sequence in dataset[column]])
+
+    return pc.list_value_length(dataset.data.column(column)).to_numpy()
+
+
+class LengthGroupedBatchSampler(Sampler):
+    def __init__(
+        self,
+        lengths,
+        batch_size,
+        shuffle=True,
+        bucket_batches=50,
+        seed=0,
+        sampler=None,
+    ):
+        self.lengths = np.asarray(lengths)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.bucket_size = batch_size * bucket_batches
+        self.seed = seed
+        self.sampler = sampler
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+        if self.sampler is not None:
+            self.sampler.set_epoch(epoch)
+
+    def indices(self):
+        if self.sampler is None:
+            return np.arange(len(self.lengths))
+
+        return np.asarray(self.sampler.indices())
+
+    def batches(self):
+        indices = self.indices()
+
+        if not self.shuffle:
+            order = indices[np.argsort(self.lengths[indices], kind="stable")]
+            buckets = [order]
+        else:
+            rng = np.random.default_rng(self.seed + self.epoch)
+            order = rng.permutation(indices)
+            buckets = [
+                order[start : start + self.bucket_size]
+                for start in range(0, len(order), self.bucket_size)
+            ]
+
+        batches = []
+
+        for bucket in buckets:
+            bucket = bucket[np.argsort(self.lengths[bucket], kind="stable")]
+
+            for start in range(0, len(bucket), self.batch_size):
+                batches.append(bucket[start : start + self.batch_size].tolist())
+
+        if self.shuffle:
+            batches = [batches[i] for i in rng.permutation(len(batches))]
+
+        return batches
+
+    def __iter__(self):
+        return iter(self.batches())
+
+    def __len__(self):
+        num_examples = len(self.lengths) if self.sampler is None else len(self.sampler)
+
+        return (num_examples + self.batch_size - 1) // self.batch_size
+
+
+def padding_tokens(lengths, batches):
+    return sum(
+        int(lengths[batch].max()) * len(batch) - int(lengths[batch].sum())
+        for batch in batches
+    )
+
+
+def report_padding(name, lengths, batch_sampler, fixed_length=0):
+    # Compares against the previous batching, which took batches in sampling
+    # order with every sequence padded to at least fixed_length tokens
+    lengths = np.asarray(lengths)
+    padded_lengths = np.maximum(lengths, fixed_length)
+    batch_size = batch_sampler.batch_size
+    indices = batch_sampler.indices()
+
+    sequential_batches = [
+        indices[start : start + batch_size]
+        for start in range(0, len(indices), batch_size)
+    ]
+    previous_padding = padding_tokens(padded_lengths, sequential_batches) + int(
+        (padded_lengths - lengths)[indices].sum()
+    )
+    grouped_padding = padding_tokens(lengths, batch_sampler.batches())
+
+    saved = previous_padding - grouped_padding
+
+    print(
+        name
+        + " Padding Tokens: "
+        + str(grouped_padding)
+        + " with Length Grouping, "
+        + str(previous_padding)
+        + " before ("
+        + str(saved)
+        + " saved, "
+        + str(round(100 * saved / max(previous_padding, 1), 2))
+        + "%)"
+    )
@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+"""Dataset Manifests
+
+Data processing writes a manifest.json next to every saved DatasetDict. It
+holds the row and label counts of each split, a histogram of the word lengths
+of its examples and the pair counters of the build. The tokenization cache
+adds the token lengths of every split. Training loops read class weights and
+length statistics from the manifests instead of iterating over the datasets.
+"""
+
+import json
+import os
+
+import numpy as np
+
+MANIFEST_VERSION = 1
+
+
+def length_histogram(lengths):
+    # Entry i is the number of examples of length i
+    return np.bincount(np.asarray(lengths, dtype=np.int64)).tolist()
+
+
+def split_summary(labels, num_labels, word_lengths):
+    return {
+        "rows": len(word_lengths),
+        "label_counts": np.bincount(
+            np.asarray(labels, dtype=np.int64), minlength=num_labels
+        ).tolist(),
+        "word_lengths": length_histogram(word_lengths),
+    }
+
+
+def token_lengths(dataset):
+    # Padded sequences are measured by their attention mask
+    attention_mask = dataset.data.column("attention_mask").combine_chunks()
+    cumulative = np.concatenate([[0], np.cumsum(attention_mask.values.to_numpy())])
+    offsets = attention_mask.offsets.to_numpy()
+
+    return cumulative[offsets[1:]] - cumulative[offsets[:-1]]
+
+
+def tokenized_manifest(datasets, max_length):
+    splits = {}
+
+    for split in datasets:
+        lengths = token_lengths(datasets[split])
+
+        splits[split] = {
+            "rows": len(lengths),
+            "token_lengths": length_histogram(lengths),
+            # Not a truncation count: NER sequences are truncated to
+            # max_length, while flow sequences are never truncated and may
+            # run past it
+            "max_length_or_longer": int(np.sum(lengths >= max_length)),
+        }
+
+    return {"max_length": max_length, "splits": splits}
+
+
+def save_manifest(dataset_dir, manifest):
+    manifest_path = os.path.join(dataset_dir, "manifest.json")
+    temp_path = manifest_path + "." + str(os.getpid()) + ".tmp"
+
+    with open(temp_path, "w", encoding="utf-8") as manifest_file:
+        json.dump({"version": MANIFEST_VERSION, **manifest}, manifest_file)
+
+    os.replace(temp_path, manifest_path)
+
+
+def load_manifest(dataset_dir):
+    manifest_path = os.path.join(dataset_dir, "manifest.json")
+
+    if not os.path.exists(manifest_path):
+        raise Exception(
+            "Missing Manifest at " + dataset_dir + ", Re-Run Data Processing"
+        )
+
+    with open(manifest_path, "r", encoding="utf-8") as manifest_file:
+        manifest = json.load(manifest_file)
+
+    if manifest["version"] != MANIFEST_VERSION:
+        raise Exception("Unsupported Manifest Version at " + dataset_dir)
+
+    return manifest
+
+
+def histogram_percentile(histogram, percentile):
+    cumulative = np.cumsum(histogram)
+
+    return int(np.searchsorted(cumulative, cumulative[-1] * percentile / 100))
+
+
+def report_lengths(name, histogram):
+    if sum(histogram) == 0:
+        return
+
+    print(
+        name
+        + " Lengths: Median "
+        + str(histogram_percentile(histogram, 50))
+        + ", 95th Percentile "
+        + str(histogram_percentile(histogram, 95))
+        + ", 99th Percentile "
+        + str(histogram_percentile(histogram, 99))
+        + ", Max "
+        + str(len(histogram) - 1)
+    )
+
+
+def report_manifest(manifest):
+    if "counts" in manifest:
+        print(
+            "Included Pairs: "
+            + str(manifest["counts"]["included"])
+            + ", Rejected Pairs: "
+            + str(manifest["counts"]["rejected"])
+            + ", Edges: "
+            + str(manifest["counts"]["edges"])
+        )
+
+    for split, summary in manifest["splits"].items():
+        print(split.capitalize() + " Rows: " + str(summary["rows"]))
+
+        if "word_lengths" in summary:
+            report_lengths(split.capitalize() + " Word", summary["word_lengths"])
+
+        if "token_lengths" in summary:
+            report_lengths(split.capitalize() + " Token", summary["token_lengths"])
+            print(
+                split.capitalize()
+                + " Sequences of Max Length "
+                + str(manifest["max_length"])
+                + " or Longer: "
+                + str(summary["max_length_or_longer"])
+            )
@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+"""Entity Marker Splicing
+
+Encodes entity-marked sentences from a sentence's word list and the
+precomputed spans of its entities. MarkerTokenizer tokenizes every base
+sentence once and splices the marker ids in at the span boundaries for each
+pair, instead of tokenizing every marked sentence as text.
+"""
+
+
+def marker_insertions(markers):
+    # markers holds (start, end, opening_marker, closing_marker) word spans,
+    # which never overlap since a new entity always closes the previous one.
+    # Returns the (word position, marker) insertions in sentence order
+    insertions = []
+    previous_end = 0
+
+    for start, end, opening_marker, closing_marker in sorted(markers):
+        if start < previous_end:
+            raise Exception("Overlapping Entity Markers")
+
+        insertions.append((start, opening_marker))
+        insertions.append((end, closing_marker))
+        previous_end = end
+
+    return insertions
+
+
+class MarkerTokenizer:
+    # Produces the same encodings as calling the tokenizer on marked sentences,
+    # relying on the tokenizer splitting words on whitespace without looking at
+    # their neighbours, as the BERT pre-tokenizer does
+    def __init__(self, tokenizer, markers):
+        self.tokenizer = tokenizer
+        self.marker_ids = {
+            marker: tokenizer.convert_tokens_to_ids(marker) for marker in markers
+        }
+        self.word_token_ids = {}
+
+    def tokenize_sentences(self, sentences):
+        # Each distinct base sentence is only tokenized once, however many
+        # pairs it is marked for
+        missing = list(
+            dict.fromkeys(
+                words for words in sentences if words not in self.word_token_ids
+            )
+        )
+
+        if not missing:
+            return
+
+        encoding = self.tokenizer(
+            [list(words) for words in missing],
+            is_split_into_words=True,
+            add_special_tokens=False,
+        )
+
+        for index, words in enumerate(missing):
+            token_ids = [[] for _ in words]
+
+            for token_id, word_id in zip(
+                encoding["input_ids"][index], encoding.word_ids(index)
+            ):
+                token_ids[word_id].append(token_id)
+
+            self.word_token_ids[words] = token_ids
+
+    def sentence_ids(self, words, insertions):
+        input_ids, previous_position = [], 0
+
+        for position, marker in insertions:
+            for word_ids in self.word_token_ids[words][previous_position:position]:
+                input_ids += word_ids
+
+            input_ids.append(self.marker_ids[marker])
+            previous_position = position
+
+        for word_ids in self.word_token_ids[words][previous_position:]:
+            input_ids += word_ids
+
+        return input_ids
+
+    def encode(self, first_sentences, second_sentences, max_length, padding):
+        # Sentences are given as (words, insertions) pieces, with words as a
+        # tuple and insertions as returned by marker_insertions
+        tokenizer = self.tokenizer
+
+        self.tokenize_sentences(
+            [words for words, _ in first_sentences]
+            + [words for words, _ in filter(None, second_sentences)]
+        )
+
+        encoding = {"input_ids": [], "token_type_ids": [], "attention_mask": []}
+
+        for first_sentence, second_sentence in zip(first_sentences, second_sentences):
+            input_ids = (
+                [tokenizer.cls_token_id]
+                + self.sentence_ids(*first_sentence)
+                + [tokenizer.sep_token_id]
+            )
+            token_type_ids = [0] * len(input_ids)
+
+            if second_sentence is not None:
+                second_ids = self.sentence_ids(*second_sentence) + [
+                    tokenizer.sep_token_id
+                ]
+                input_ids += second_ids
+                token_type_ids += [1] * len(second_ids)
+
+            attention_mask = [1] * len(input_ids)
+
+            if padding == "max_length" and len(input_ids) < max_length:
+                num_padding = max_length - len(input_ids)
+                input_ids += [tokenizer.pad_token_id] * num_padding
+                token_type_ids += [tokenizer.pad_token_type_id] * num_padding
+                attention_mask += [0] * num_padding
+
+            encoding["input_ids"].append(input_ids)
+            encoding["token_type_ids"].append(token_type_ids)
+            encoding["attention_mask"].append(attention_mask)
+
+        return encoding
@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+"""Per-Epoch Negative Resampling
+
+Samples the training pairs of every epoch from the full pair table instead of
+training on one undersampled dataset. All edge examples are kept and a fresh,
+seeded subset of the non-edge examples is drawn every epoch, always of the
+same size, so one dataset serves every undersample factor of a sweep and an
+epoch only costs as much as its sample.
+"""
+
+import numpy as np
+from torch.utils.data import Sampler
+
+
+def kept_negatives(num_negatives, num_edges, undersample_factor, balanced_at_one):
+    # Number of non-edge examples kept by an undersample factor, the same as
+    # undersample() in data processing. With balanced_at_one, a factor of 1
+    # keeps as many non-edge examples as there are edge examples
+    if balanced_at_one and undersample_factor == 1:
+        return min(num_edges, num_negatives)
+
+    return num_negatives - int(num_negatives * undersample_factor)
+
+
+class NegativeResamplingSampler(Sampler):
+    def __init__(self, labels, negative_label, num_kept, shuffle=True, seed=0):
+        labels = np.asarray(labels)
+
+        self.edge_indices = np.flatnonzero(labels != negative_label)
+        self.negative_indices = np.flatnonzero(labels == negative_label)
+        self.num_kept = num_kept
+        self.shuffle = shuffle
+        self.seed = seed
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def indices(self):
+        rng = np.random.default_rng(self.seed + self.epoch)
+
+        kept_indices = rng.choice(
+            self.negative_indices, size=self.num_kept, replace=False
+        )
+        indices = np.concatenate([self.edge_indices, kept_indices])
+
+        if self.shuffle:
+            return rng.permutation(indices)
+
+        return np.sort(indices)
+
+    def __iter__(self):
+        return iter(self.indices().tolist())
+
+    def __len__(self):
+        return len(self.edge_indices) + self.num_kept
+
+
+def non_edge_resampler(
+    dataset, undersample_factor, balanced_at_one=False, shuffle=True, seed=0
+):
+    labels = np.asarray(dataset["labels"])
+    non_edge_id = dataset.features["labels"].str2int("non-edge")
+    num_negatives = int(np.sum(labels == non_edge_id))
+
+    return NegativeResamplingSampler(
+        labels,
+        non_edge_id,
+        kept_negatives(
+            num_negatives,
+            len(labels) - num_negatives,
+            undersample_factor,
+            balanced_at_one,
+        ),
+        shuffle=shuffle,
+        seed=seed,
+    )
@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+"""Direct NER Dataset Build
+
+Builds the NER dataset straight from the token tables of the corpus cache.
+Sentences are cut at every "." POS tag with NumPy and stored as Arrow list
+arrays of words, POS ids and NER tag ids, instead of writing every token to a
+CSV file and grouping the rows back into sentences with pandas.
+"""
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+from datasets import ClassLabel, Dataset, DatasetInfo, Features, Sequence, Value
+
+from shared.manifest import split_summary
+
+
+def ner_label_names(corpus):
+    label_names = sorted(corpus.tags)
+
+    label_names.remove("O")
+    label_names.append("O")
+
+    return label_names
+
+
+def recipe_order(corpus, ner_files):
+    # Indices of the corpus recipes in the order of ner_files
+    indices = {ner_file: index for index, ner_file in enumerate(corpus.ner_files)}
+
+    return [indices[ner_file] for ner_file in ner_files]
+
+
+def ner_token_tables(corpus, ner_files):
+    offsets = corpus.tables["token_offsets"]
+    token_order = np.concatenate(
+        [
+            np.arange(offsets[index], offsets[index + 1])
+            for index in recipe_order(corpus, ner_files)
+        ]
+    )
+
+    return {
+        column: np.asarray(corpus.tables[column])[token_order]
+        for column in ["word_id", "pos_id", "tag_id"]
+    }
+
+
+def pos_names_by_appearance(corpus, pos_ids):
+    # POS tags in the order of their first token, like the unique() of the CSV
+    # build, with the ids remapped to that order
+    ids, first_tokens = np.unique(pos_ids, return_index=True)
+    appearance = ids[np.argsort(first_tokens)]
+
+    remap = np.zeros(len(corpus.pos), dtype=np.int64)
+    remap[appearance] = np.arange(len(appearance))
+
+    return [corpus.pos[pos_id] for pos_id in appearance], remap[pos_ids]
+
+
+def sentence_offsets(pos_ids, full_stop_id):
+    # A sentence ends at every "." POS tag and otherwise runs on across the
+    # end of a recipe, like the sentence numbers of the CSV export
+    sentence_ends = np.flatnonzero(pos_ids == full_stop_id) + 1
+
+    return np.unique(np.concatenate([[0], sentence_ends, [len(pos_ids)]]))
+
+
+def build_ner_dataset(corpus, ner_files):
+    # Recipes are read in the order of ner_files, the unsorted glob order of
+    # the CSV build, since sentences run on across recipes
+    tables = ner_token_tables(corpus, ner_files)
+    pos_names, all_pos_ids = pos_names_by_appearance(corpus, tables["pos_id"])
+
+    offsets = sentence_offsets(all_pos_ids, pos_names.index("."))
+    lengths = np.diff(offsets)
+
+    # Sentences are listed in the order of their "Sentence_N" names, in which
+    # the groupby of the CSV build returned them, so that the seeded shuffle
+    # still draws the same splits
+    order = np.array(
+        sorted(range(len(lengths)), key=lambda sentence: str(sentence + 1)),
+        dtype=np.int64,
+    )
+    sorted_lengths = lengths[order]
+    sorted_offsets = np.concatenate([[0], np.cumsum(sorted_lengths)])
+
+    token_indices = (
+        np.arange(sorted_offsets[-1])
+        - np.repeat(sorted_offsets[:-1], sorted_lengths)
+        + np.repeat(offsets[:-1][order], sorted_lengths)
+    )
+
+    word_ids = tables["word_id"][token_indices]
+    pos_ids = all_pos_ids[token_indices]
+    tag_ids = tables["tag_id"][token_indices]
+
+    label_names = ner_label_names(corpus)
+    label_ids = np.array([label_names.index(tag) for tag in corpus.tags])
+
+    # Tokens without a POS tag were read back from the CSV as missing values
+    pos_mask = np.zeros(len(pos_ids), dtype=bool)
+
+    if "" in pos_names:
+        pos_mask = pos_ids == pos_names.index("")
+
+    list_offsets = pa.array(sorted_offsets, type=pa.int32())
+    table = pa.table(
+        {
+            "tokens": pa.ListArray.from_arrays(
+                list_offsets,
+                pa.array(np.array(corpus.words, dtype=object)[word_ids], pa.string()),
+            ),
+            "pos": pa.ListArray.from_arrays(
+                list_offsets, pa.array(pos_ids, pa.int64(), mask=pos_mask)
+            ),
+            "ner_tags": pa.ListArray.from_arrays(
+                list_offsets, pa.array(label_ids[tag_ids], pa.int64())
+            ),
+        }
+    )
+
+    features = Features(
+        {
+            "tokens": Sequence(Value("string")),
+            "pos": Sequence(ClassLabel(names=pos_names)),
+            "ner_tags": Sequence(ClassLabel(names=label_names)),
+        }
+    )
+
+    return Dataset(table, info=DatasetInfo(features=features))
+
+
+def ner_manifest(datasets):
+    # Label counts of the NER datasets count the tags of every token
+    label_names = datasets["train"].features["ner_tags"].feature.names
+    splits = {}
+
+    for split, dataset in datasets.items():
+        ner_tags = dataset.data.column("ner_tags")
+
+        splits[split] = split_summary(
+            pc.list_flatten(ner_tags).to_numpy(),
+            len(label_names),
+            pc.list_value_length(ner_tags).to_numpy(),
+        )
+
+    return {"label_names": label_names, "splits": splits}
@@ -0,0 +1,220 @@
+# -*- coding: utf-8 -*-
+"""Sentence and Pair Tables
+
+Flow datasets are stored as a table holding every recipe sentence once and a
+table of candidate pairs that only refers to those sentences by id and to the
+two entities by their word spans. The marked sentences, word pairs and
+sentence pairs of the encoding strategies are only put together from the two
+tables when a training loop tokenizes the pairs.
+"""
+
+import json
+import os
+
+import numpy as np
+import pyarrow.compute as pc
+from datasets import Dataset, Features, Sequence, Value, load_from_disk
+
+from shared.markers import marker_insertions
+from shared.positions import sentence_of
+
+SENTENCE_FEATURES = Features(
+    {"Words": Sequence(Value("string")), "Tags": Sequence(Value("string"))}
+)
+PAIR_FEATURES = Features(
+    {
+        "Source Sentence": Value("int32"),
+        "Source Start": Value("int16"),
+        "Source End": Value("int16"),
+        "Dest Sentence": Value("int32"),
+        "Dest Start": Value("int16"),
+        "Dest End": Value("int16"),
+        "Label": Value("int8"),
+    }
+)
+
+
+class PairRows:
+    # Column lists of the pairs of one recipe, referring to its sentences by
+    # their index within the recipe
+    def __init__(self, recipe):
+        self.recipe = recipe
+        self.sentence_ids = {
+            sentence: sentence_id
+            for sentence_id, sentence in enumerate(recipe.sentence_slices)
+        }
+        self.columns = {column: [] for column in PAIR_FEATURES}
+
+    def append(self, source_key, dest_key, label):
+        for entity, key in [("Source", source_key), ("Dest", dest_key)]:
+            start, end = self.recipe.entity_spans[key]
+
+            self.columns[entity + " Sentence"].append(
+                self.sentence_ids[sentence_of(key)]
+            )
+            self.columns[entity + " Start"].append(start)
+            self.columns[entity + " End"].append(end)
+
+        self.columns["Label"].append(label)
+
+    def shard(self):
+        sentences = {"Words": [], "Tags": []}
+
+        for start, end in self.recipe.sentence_slices.values():
+            tokens = self.recipe.tokens[start:end]
+
+            sentences["Words"].append([word for _, word, _, _ in tokens])
+            sentences["Tags"].append([ner_tag for _, _, _, ner_tag in tokens])
+
+        return sentences, self.columns
+
+
+class PairTableBuilder:
+    # Merges recipe shards into one sentence table and one pair table, moving
+    # the sentence ids of every shard past the sentences of the shards before
+    # it and replacing the labels with small integer codes
+    def __init__(self):
+        self.sentences = {"Words": [], "Tags": []}
+        self.label_ids = {}
+
+    def add_shard(self, shard):
+        sentences, columns = shard
+        sentence_offset = len(self.sentences["Words"])
+
+        for column in self.sentences:
+            self.sentences[column] += sentences[column]
+
+        for row in zip(*columns.values()):
+            row = dict(zip(columns, row))
+            row["Source Sentence"] += sentence_offset
+            row["Dest Sentence"] += sentence_offset
+            row["Label"] = self.label_ids.setdefault(row["Label"], len(self.label_ids))
+
+            if row["Label"] > np.iinfo(np.int8).max:
+                raise Exception("Too Many Labels for a Pair Table")
+
+            yield row
+
+    def sentence_table(self):
+        return Dataset.from_dict(self.sentences, features=SENTENCE_FEATURES)
+
+    def label_names(self):
+        return list(self.label_ids)
+
+
+class SentenceTable:
+    def __init__(self, sentences):
+        self.words = [tuple(words) for words in sentences["Words"]]
+        self.texts = [" ".join(words) for words in self.words]
+        self.entity_types = [
+            [ner_tag.replace("-B", "").replace("-I", "") for ner_tag in tags]
+            for tags in sentences["Tags"]
+        ]
+
+
+def load_sentence_table(view_dir):
+    with open(os.path.join(view_dir, "view.json"), "r", encoding="utf-8") as file:
+        dataset_dir = json.load(file)["dataset_dir"]
+
+    return SentenceTable(load_from_disk(os.path.join(dataset_dir, "sentences")))
+
+
+def pair_word_lengths(pairs, sentences):
+    # Number of words in the sentences of every pair, counting a sentence that
+    # holds both entities once
+    sentence_lengths = pc.list_value_length(sentences.data.column("Words")).to_numpy()
+    source_sentences = pairs.data.column("Source Sentence").to_numpy()
+    dest_sentences = pairs.data.column("Dest Sentence").to_numpy()
+
+    return sentence_lengths[source_sentences] + np.where(
+        source_sentences == dest_sentences, 0, sentence_lengths[dest_sentences]
+    )
+
+
+def entity_marker(number, entity_type=None):
+    if entity_type is None:
+        opening_marker = "<e" + str(number) + ">"
+    else:
+        opening_marker = "<e" + str(number) + " type=" + entity_type + ">"
+
+    return opening_marker, "</e" + str(number) + ">"
+
+
+def marked_sentence_pairs(data, sentence_table, typed=False):
+    # Returns the (words, insertions) pieces of the first and second sentence
+    # of every pair for MarkerTokenizer.encode. Both entities are marked in one
+    # sentence when they share it, which then has no second sentence
+    first_sentences, second_sentences = [], []
+
+    for index in range(len(data["Label"])):
+        source_sentence = data["Source Sentence"][index]
+        dest_sentence = data["Dest Sentence"][index]
+
+        source_start = data["Source Start"][index]
+        dest_start = data["Dest Start"][index]
+
+        source_type, dest_type = None, None
+
+        if typed:
+            source_type = sentence_table.entity_types[source_sentence][source_start]
+            dest_type = sentence_table.entity_types[dest_sentence][dest_start]
+
+        source_marker = (source_start, data["Source End"][index])
+        source_marker += entity_marker(1, source_type)
+        dest_marker = (dest_start, data["Dest End"][index])
+        dest_marker += entity_marker(2, dest_type)
+
+        if source_sentence == dest_sentence:
+            first_sentences.append(
+                (
+                    sentence_table.words[source_sentence],
+                    marker_insertions([source_marker, dest_marker]),
+                )
+            )
+            second_sentences.append(None)
+        else:
+            first_sentences.append(
+                (
+                    sentence_table.words[source_sentence],
+                    marker_insertions([source_marker]),
+                )
+            )
+            second_sentences.append(
+                (
+                    sentence_table.words[dest_sentence],
+                    marker_insertions([dest_marker]),
+                )
+            )
+
+    return first_sentences, second_sentences
+
+
+def directional_pair_inputs(data, sentence_table, ordered=False):
+    # Returns the word pair and sentence pair strings of every pair. With
+    # ordered, the word pair follows the token order of the two entities,
+    # which sentence ids and word offsets within a recipe both keep
+    word_pairs, sentence_pairs = [], []
+
+    for index in range(len(data["Label"])):
+        source_sentence = data["Source Sentence"][index]
+        dest_sentence = data["Dest Sentence"][index]
+        source_start = data["Source Start"][index]
+        dest_start = data["Dest Start"][index]
+
+        source_word = sentence_table.words[source_sentence][source_start]
+        dest_word = sentence_table.words[dest_sentence][dest_start]
+
+        if ordered and (source_sentence, source_start) > (dest_sentence, dest_start):
+            word_pairs.append(dest_word + " " + source_word)
+        else:
+            word_pairs.append(source_word + " " + dest_word)
+
+        source_text = sentence_table.texts[source_sentence]
+        dest_text = sentence_table.texts[dest_sentence]
+
+        if source_text == dest_text:
+            sentence_pairs.append(source_text)
+        else:
+            sentence_pairs.append(source_text + " " + dest_text)
+
+    return word_pairs, sentence_pairs
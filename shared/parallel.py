@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+"""Parallel Per-Recipe Dataset Construction
+
+Hands recipes to a pool of worker processes, each returning the rows of one
+recipe as a shard. Shards are yielded back in recipe order, so merging them
+gives exactly the rows of a serial build. With a shard cache, only recipes
+without a cached shard are handed out.
+"""
+
+import multiprocessing
+import os
+import time
+from collections import defaultdict
+
+from tqdm import tqdm
+
+
+def run_shard(arguments):
+    construct_shard, recipe_index = arguments
+    start_time = time.time()
+    shard = construct_shard(recipe_index)
+
+    return os.getpid(), time.time() - start_time, shard
+
+
+def construct_shards(construct_shard, recipe_indices, workers=1):
+    if workers <= 1:
+        for recipe_index in tqdm(recipe_indices, desc="Constructing Recipes"):
+            yield construct_shard(recipe_index)
+        return
+
+    # Fork so that workers share the already loaded corpus and relation set
+    # instead of re-running the calling script
+    context = multiprocessing.get_context("fork")
+
+    worker_recipes, worker_seconds = defaultdict(int), defaultdict(float)
+    progress_bar = tqdm(total=len(recipe_indices), desc="Constructing Recipes")
+
+    with context.Pool(workers) as pool:
+        for pid, seconds, shard in pool.imap(
+            run_shard,
+            [(construct_shard, recipe_index) for recipe_index in recipe_indices],
+        ):
+            worker_recipes[pid] += 1
+            worker_seconds[pid] += seconds
+
+            progress_bar.set_postfix(
+                {"worker " + str(pid): count for pid, count in worker_recipes.items()},
+                refresh=False,
+            )
+            progress_bar.update(1)
+
+            yield shard
+
+    progress_bar.close()
+
+    for pid in sorted(worker_recipes):
+        print(
+            "Worker "
+            + str(pid)
+            + ": "
+            + str(worker_recipes[pid])
+            + " recipes in "
+            + str(round(worker_seconds[pid], 2))
+            + " seconds"
+        )
+
+
+def build_shards(construct_shard, num_recipes, workers=1, shard_cache=None):
+    if shard_cache is None:
+        yield from construct_shards(construct_shard, list(range(num_recipes)), workers)
+        return
+
+    missing_indices = [
+        recipe_index
+        for recipe_index in range(num_recipes)
+        if not shard_cache.contains(recipe_index)
+    ]
+
+    print(
+        "Reusing "
+        + str(num_recipes - len(missing_indices))
+        + " cached recipe shards, rebuilding "
+        + str(len(missing_indices))
+    )
+
+    built_shards = construct_shards(construct_shard, missing_indices, workers)
+    missing_indices = set(missing_indices)
+
+    for recipe_index in range(num_recipes):
+        if recipe_index in missing_indices:
+            shard = next(built_shards)
+            shard_cache.save(recipe_index, shard)
+        else:
+            shard = shard_cache.load(recipe_index)
+
+        yield shard
+
+    # Let the pool shut down and report its workers
+    for _ in built_shards:
+        pass
+
+    shard_cache.prune()
@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+"""Packed Token Positions
+
+Packs a (step, sentence, offset) token position into a single int64 so that
+positions can be hashed and compared without building "step;sentence;offset"
+strings. Packing keeps the ordering of the original tuples, so sorting and
+"<" comparisons on packed keys behave exactly like they do on the tuples.
+"""
+
+import numpy as np
+
+FIELD_BITS = 21
+FIELD_LIMIT = 1 << FIELD_BITS
+
+SENTENCE_SHIFT = FIELD_BITS
+STEP_SHIFT = 2 * FIELD_BITS
+
+
+def pack_positions(steps, sentences, offsets):
+    steps, sentences, offsets = (
+        np.asarray(steps, dtype=np.int64),
+        np.asarray(sentences, dtype=np.int64),
+        np.asarray(offsets, dtype=np.int64),
+    )
+
+    for field in (steps, sentences, offsets):
+        if len(field) and (field.min() < 0 or field.max() >= FIELD_LIMIT):
+            raise Exception("Position Out of Range During Packing")
+
+    return (steps << STEP_SHIFT) | (sentences << SENTENCE_SHIFT) | offsets
+
+
+def sentence_of(key):
+    # Packed (step, sentence) prefix, equal for all tokens of one sentence
+    return key >> SENTENCE_SHIFT
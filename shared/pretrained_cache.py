@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+"""In-Memory Pretrained Checkpoints
+
+Once enabled, for example by a sweep that runs several training loops in one
+process, tokenizers and the pretrained weights of every checkpoint are kept
+in memory after their first load. Later runs get a copy of the tokenizer.
+Their models are built from the config and filled with a pristine copy of
+the pretrained weights instead of reading the checkpoint from disk again.
+Weights the checkpoint does not hold, such as a new classifier head, are
+freshly initialized every run just like from_pretrained does.
+"""
+
+import copy
+
+from transformers import AutoConfig, AutoTokenizer
+
+KEEP_IN_MEMORY = False
+
+_TOKENIZERS = {}
+_STATE_DICTS = {}
+
+
+def keep_pretrained_in_memory():
+    global KEEP_IN_MEMORY
+    KEEP_IN_MEMORY = True
+
+
+def pretrained_tokenizer(checkpoint):
+    if not KEEP_IN_MEMORY:
+        return AutoTokenizer.from_pretrained(checkpoint)
+
+    if checkpoint not in _TOKENIZERS:
+        _TOKENIZERS[checkpoint] = AutoTokenizer.from_pretrained(checkpoint)
+
+    # Runs add their own marker tokens to the tokenizer they are given
+    return copy.deepcopy(_TOKENIZERS[checkpoint])
+
+
+def pretrained_model(model_class, checkpoint, **kwargs):
+    if not KEEP_IN_MEMORY:
+        return model_class.from_pretrained(checkpoint, **kwargs)
+
+    key = (model_class.__name__, checkpoint)
+
+    if key not in _STATE_DICTS:
+        model, loading_info = model_class.from_pretrained(
+            checkpoint, output_loading_info=True, **kwargs
+        )
+        missing_keys = set(loading_info["missing_keys"])
+
+        _STATE_DICTS[key] = {
+            name: tensor.detach().clone()
+            for name, tensor in model.state_dict().items()
+            if name not in missing_keys
+        }
+
+        return model
+
+    model = model_class.from_config(AutoConfig.from_pretrained(checkpoint, **kwargs))
+    model.load_state_dict(_STATE_DICTS[key], strict=False)
+    model.eval()
+
+    return model
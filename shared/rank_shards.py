@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+"""Rank Shards
+
+Splits every split of an index view into one shard per training process, each
+saved as its own small table, so that the ranks of a multi-node job each load
+only their own rows. Rows are dealt out label by label, so every shard holds
+the labels in the same proportions. Train shards leave out the fewer than
+num_shards rows left over after dealing, rather than repeating rows, so every
+rank takes the same number of steps on the rows of the unsharded split.
+"""
+
+import json
+import os
+import shutil
+
+import numpy as np
+from datasets import DatasetDict, load_from_disk
+
+from shared.dataset_views import load_index_view, read_build_info, replace_dir
+
+
+def stratified_shards(labels, num_shards, drop_last=False):
+    labels = np.asarray(labels)
+    unique_labels, counts = np.unique(labels, return_counts=True)
+
+    # The most common label comes last, so that it alone loses the rows left
+    # over after dealing
+    order = np.concatenate(
+        [
+            np.flatnonzero(labels == label)
+            for label in unique_labels[np.argsort(counts, kind="stable")]
+        ]
+    )
+
+    if drop_last:
+        order = order[: len(order) // num_shards * num_shards]
+
+    # Dealing the label-sorted rows round-robin keeps the shard sizes within
+    # one row of each other, and each shard keeps the order of the split
+    return [np.sort(order[shard::num_shards]) for shard in range(num_shards)]
+
+
+def save_rank_shards(view_dir, num_shards):
+    datasets = load_index_view(view_dir)
+
+    with open(os.path.join(view_dir, "view.json"), "r", encoding="utf-8") as file:
+        view = json.load(file)
+
+    shards_dir = os.path.join(view_dir, "shards")
+    temp_dir = shards_dir + "." + str(os.getpid()) + ".tmp"
+    shutil.rmtree(temp_dir, ignore_errors=True)
+
+    split_shards = {
+        split: stratified_shards(
+            dataset["Label"], num_shards, drop_last=split == "train"
+        )
+        for split, dataset in datasets.items()
+    }
+    dropped_rows = len(datasets["train"]) - sum(map(len, split_shards["train"]))
+
+    print(
+        "Sharding "
+        + view_dir
+        + " into "
+        + str(num_shards)
+        + " Rank Shards, Leaving Out "
+        + str(dropped_rows)
+        + " Train Rows"
+    )
+
+    for shard in range(num_shards):
+        DatasetDict(
+            {
+                split: dataset.select(split_shards[split][shard])
+                for split, dataset in datasets.items()
+            }
+        ).save_to_disk(os.path.join(temp_dir, str(shard)))
+
+    with open(os.path.join(temp_dir, "shards.json"), "w", encoding="utf-8") as file:
+        json.dump(
+            {
+                "num_shards": num_shards,
+                "build_key": view["build_key"],
+                "dropped_rows": dropped_rows,
+            },
+            file,
+        )
+
+    replace_dir(temp_dir, shards_dir)
+
+
+def load_rank_shard(view_dir, process_index, num_processes):
+    # Returns the shard of this process, or None when the view was not sharded
+    # for this number of processes and the full view has to be loaded
+    shards_path = os.path.join(view_dir, "shards", "shards.json")
+
+    if num_processes == 1 or not os.path.exists(shards_path):
+        return None
+
+    with open(shards_path, "r", encoding="utf-8") as file:
+        shards = json.load(file)
+
+    if shards["num_shards"] != num_processes:
+        print(
+            "Ignoring "
+            + str(shards["num_shards"])
+            + " Rank Shards of "
+            + view_dir
+            + " for "
+            + str(num_processes)
+            + " Processes"
+        )
+        return None
+
+    with open(os.path.join(view_dir, "view.json"), "r", encoding="utf-8") as file:
+        build_info = read_build_info(json.load(file)["dataset_dir"])
+
+    if build_info is None or build_info["build_key"] != shards["build_key"]:
+        raise Exception(
+            "Full Dataset Was Rebuilt Since "
+            + view_dir
+            + " Was Sharded, Re-Run Data Processing"
+        )
+
+    return load_from_disk(os.path.join(view_dir, "shards", str(process_index)))
@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+"""Tag-Pair Relation Matrix
+
+Compiles the relation set of "source->dest" NER tag pairs into a boolean
+tag-by-tag matrix, so that the candidate entity pairs of a recipe can be found
+with a single NumPy broadcast instead of formatting and probing a string for
+every pair of entities.
+"""
+
+import os
+import pickle
+
+import numpy as np
+
+
+class RelationMatrix:
+    def __init__(self, tags, matrix):
+        self.tags = list(tags)
+        self.tag_ids = {tag: tag_id for tag_id, tag in enumerate(self.tags)}
+
+        # Tags that never appear in the relation set share an extra last row
+        # and column, which never allows a pair
+        self.matrix = np.zeros((len(self.tags) + 1, len(self.tags) + 1), dtype=bool)
+        self.matrix[:-1, :-1] = matrix
+        self.symmetric_matrix = self.matrix | self.matrix.T
+
+    @classmethod
+    def from_relation_set(cls, relation_set):
+        relations = [relation.split("->") for relation in relation_set]
+        tags = sorted({tag for relation in relations for tag in relation})
+        tag_ids = {tag: tag_id for tag_id, tag in enumerate(tags)}
+
+        matrix = np.zeros((len(tags), len(tags)), dtype=bool)
+
+        for source_tag, dest_tag in relations:
+            matrix[tag_ids[source_tag], tag_ids[dest_tag]] = True
+
+        return cls(tags, matrix)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as relation_matrix:
+            return cls(relation_matrix["tags"].tolist(), relation_matrix["matrix"])
+
+    def save(self, path):
+        temp_path = path + "." + str(os.getpid()) + ".npz"
+        np.savez(temp_path, tags=np.array(self.tags), matrix=self.matrix[:-1, :-1])
+        os.replace(temp_path, path)
+
+    def encode(self, ner_tags):
+        unknown_id = len(self.tags)
+
+        return np.array(
+            [self.tag_ids.get(ner_tag, unknown_id) for ner_tag in ner_tags],
+            dtype=np.int64,
+        )
+
+    def candidate_pairs(self, ner_tags, directional=False):
+        # Returns the (source, dest) indices of every allowed pair of entities
+        # in row-major order, the same order as a nested loop over the entities,
+        # together with the number of pairs that were rejected
+        tag_ids = self.encode(ner_tags)
+
+        if directional:
+            allowed = self.matrix[np.ix_(tag_ids, tag_ids)]
+            np.fill_diagonal(allowed, False)
+            num_candidates = len(tag_ids) * (len(tag_ids) - 1)
+        else:
+            allowed = np.triu(self.symmetric_matrix[np.ix_(tag_ids, tag_ids)], k=1)
+            num_candidates = len(tag_ids) * (len(tag_ids) - 1) // 2
+
+        sources, dests = np.nonzero(allowed)
+
+        return sources, dests, num_candidates - len(sources)
+
+
+def load_relation_matrix(project_dir, target_corpus):
+    relation_set_path = project_dir + target_corpus + "-relation_set.pickle"
+    relation_matrix_path = project_dir + target_corpus + "-relation_matrix.npz"
+
+    # Compile the matrix from the pickled relation set when it was never saved
+    # or the relation set has been rebuilt since
+    if not os.path.exists(relation_matrix_path) or os.path.getmtime(
+        relation_matrix_path
+    ) < os.path.getmtime(relation_set_path):
+        with open(relation_set_path, "rb") as relation_set_file:
+            relation_matrix = RelationMatrix.from_relation_set(
+                pickle.load(relation_set_file)
+            )
+
+        relation_matrix.save(relation_matrix_path)
+
+        return relation_matrix
+
+    return RelationMatrix.load(relation_matrix_path)
@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+"""Sequence Packing
+
+Packs several tokenized sentences into each training sequence of up to
+max_length tokens, instead of padding every short sentence on its own. Each
+sentence keeps its own [CLS] and [SEP] tokens, labelled -100. Its position ids
+restart at zero, and a block-diagonal attention mask keeps it from attending
+to the other sentences of its sequence. Every sentence is therefore encoded
+just as it would be unpacked. Transformers 4.x takes the mask as a 3D
+[batch, query, key] tensor, while 5.x takes a 4D [batch, head, query, key]
+boolean mask and rejects a 3D one.
+"""
+
+import numpy as np
+import torch
+import transformers
+from torch.utils.data import Dataset
+
+from shared.tensor_loading import column_arrays
+
+FOUR_DIMENSIONAL_MASK = int(transformers.__version__.split(".")[0]) >= 5
+
+
+def pack_sentences(lengths, max_length):
+    # First-fit decreasing: the longest sentences are placed first, each into
+    # the first sequence that still has room for it
+    lengths = np.asarray(lengths, dtype=np.int64)
+    remaining = np.empty(len(lengths), dtype=np.int64)
+    pack_ids = np.empty(len(lengths), dtype=np.int64)
+    num_packs = 0
+
+    for sentence in np.argsort(-lengths, kind="stable"):
+        fits = np.flatnonzero(remaining[:num_packs] >= lengths[sentence])
+
+        if len(fits) > 0:
+            pack_id = fits[0]
+        else:
+            pack_id = num_packs
+            remaining[pack_id] = max_length
+            num_packs += 1
+
+        remaining[pack_id] -= lengths[sentence]
+        pack_ids[sentence] = pack_id
+
+    packs = [[] for _ in range(num_packs)]
+
+    for sentence, pack_id in enumerate(pack_ids.tolist()):
+        packs[pack_id].append(sentence)
+
+    # Sequences follow the order of their first sentences in the dataset
+    return sorted(packs)
+
+
+class PackedDataset(Dataset):
+    def __init__(self, dataset, max_length):
+        self.input_ids, self.offsets = column_arrays(dataset.data.column("input_ids"))
+        self.labels, _ = column_arrays(dataset.data.column("labels"))
+        self.lengths = np.diff(self.offsets)
+        self.packs = pack_sentences(self.lengths, max_length)
+
+    def __len__(self):
+        return len(self.packs)
+
+    def __getitem__(self, index):
+        sentences = np.asarray(self.packs[index])
+        starts = self.offsets[sentences]
+        lengths = self.lengths[sentences]
+
+        tokens = np.concatenate(
+            [np.arange(start, start + length) for start, length in zip(starts, lengths)]
+        )
+        sentence_starts = np.repeat(np.cumsum(lengths) - lengths, lengths)
+
+        return {
+            "input_ids": self.input_ids[tokens],
+            "labels": self.labels[tokens],
+            "position_ids": np.arange(len(tokens)) - sentence_starts,
+            "segment_ids": np.repeat(np.arange(1, len(sentences) + 1), lengths),
+        }
+
+
+class PackedCollator:
+    def __init__(self, tokenizer):
+        self.pad_token_id = tokenizer.pad_token_id
+
+    def __call__(self, examples):
+        max_length = max(len(example["input_ids"]) for example in examples)
+        shape = (len(examples), max_length)
+
+        batch = {
+            "input_ids": np.full(shape, self.pad_token_id, dtype=np.int64),
+            "labels": np.full(shape, -100, dtype=np.int64),
+            "position_ids": np.zeros(shape, dtype=np.int64),
+            "segment_ids": np.zeros(shape, dtype=np.int64),
+        }
+
+        for row, example in enumerate(examples):
+            for name, values in example.items():
+                batch[name][row, : len(values)] = values
+
+        batch = {name: torch.from_numpy(values) for name, values in batch.items()}
+        segment_ids = batch.pop("segment_ids")
+
+        # Tokens attend only to the tokens of their own sentence, padding
+        # tokens to none
+        attention_mask = (segment_ids[:, :, None] == segment_ids[:, None, :]) & (
+            segment_ids[:, :, None] > 0
+        )
+
+        if FOUR_DIMENSIONAL_MASK:
+            batch["attention_mask"] = attention_mask[:, None, :, :]
+        else:
+            batch["attention_mask"] = attention_mask.long()
+
+        return batch
+
+
+def report_packing(name, packed_dataset, max_length):
+    num_tokens = int(packed_dataset.lengths.sum())
+    num_packs = len(packed_dataset)
+
+    print(
+        name
+        + " Packing: "
+        + str(len(packed_dataset.lengths))
+        + " Sentences in "
+        + str(num_packs)
+        + " Sequences, "
+        + str(round(100 * num_tokens / (num_packs * max_length), 2))
+        + "% of "
+        + str(max_length)
+        + " Tokens Filled"
+    )
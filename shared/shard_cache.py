@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+"""Per-Recipe Shard Cache
+
+Keeps the example rows built for every recipe on disk, keyed by the contents
+of the recipe's .list/.flow files, the relation set and the encoding strategy.
+A rebuild after editing a few recipes only reprocesses those recipes and reads
+the shards of all the others back from the cache.
+"""
+
+import hashlib
+import json
+import os
+import pickle
+
+from shared.ingest import INGEST_VERSION
+
+SHARD_CACHE_VERSION = 2
+
+
+def hash_relation_set(relation_set):
+    return hashlib.sha256(json.dumps(sorted(relation_set)).encode("utf-8")).hexdigest()
+
+
+class ShardCache:
+    def __init__(self, project_dir, target_corpus, strategy, corpus, relation_set):
+        self.cache_dir = project_dir + "cache/shards/" + target_corpus + "/" + strategy
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+        file_hashes = {
+            fingerprint["path"]: fingerprint["sha256"]
+            for fingerprint in corpus.fingerprints
+        }
+        relation_set_hash = hash_relation_set(relation_set)
+
+        self.keys = []
+
+        for ner_file, flow_file in zip(corpus.ner_files, corpus.flow_files):
+            key_contents = [
+                SHARD_CACHE_VERSION,
+                INGEST_VERSION,
+                strategy,
+                relation_set_hash,
+                file_hashes[ner_file],
+                file_hashes[flow_file],
+            ]
+
+            self.keys.append(
+                hashlib.sha256(json.dumps(key_contents).encode("utf-8")).hexdigest()
+            )
+
+    def shard_path(self, recipe_index):
+        return os.path.join(self.cache_dir, self.keys[recipe_index] + ".pickle")
+
+    def contains(self, recipe_index):
+        return os.path.exists(self.shard_path(recipe_index))
+
+    def load(self, recipe_index):
+        with open(self.shard_path(recipe_index), "rb") as shard_file:
+            return pickle.load(shard_file)
+
+    def save(self, recipe_index, shard):
+        shard_path = self.shard_path(recipe_index)
+        temp_path = shard_path + "." + str(os.getpid())
+
+        with open(temp_path, "wb") as shard_file:
+            pickle.dump(shard, shard_file, protocol=pickle.HIGHEST_PROTOCOL)
+
+        os.replace(temp_path, shard_path)
+
+    def prune(self):
+        # Drop the shards of recipe versions that are no longer in the corpus
+        current_files = {key + ".pickle" for key in self.keys}
+
+        for file_name in os.listdir(self.cache_dir):
+            if file_name.endswith(".pickle") and file_name not in current_files:
+                os.remove(os.path.join(self.cache_dir, file_name))
@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+"""Memory-Mapped Tensor Loading
+
+Serves batches of a tokenized dataset straight from the memory-mapped Arrow
+buffers it was saved in. Every column is viewed as a flat NumPy array plus its
+row offsets without copying, and a whole batch is cut out of those arrays at
+once and padded to its longest sequence, instead of converting each row to
+Python lists and collating a list of dicts. The DataLoader runs persistent,
+prefetching worker processes that each map the same files.
+"""
+
+import numpy as np
+import torch
+from torch.utils.data import DataLoader, Dataset
+
+
+def tokenizer_pad_values(tokenizer):
+    # The padding of DataCollatorWithPadding and DataCollatorForTokenClassification
+    return {
+        "input_ids": tokenizer.pad_token_id,
+        "token_type_ids": tokenizer.pad_token_type_id,
+        "attention_mask": 0,
+        "labels": -100,
+    }
+
+
+def column_arrays(column):
+    # Returns (values, offsets) for list columns and (values, None) for scalar
+    # columns, both viewing the Arrow buffers of the column
+    array = column.chunk(0) if column.num_chunks == 1 else column.combine_chunks()
+
+    if hasattr(array, "offsets"):
+        return (
+            array.values.to_numpy(zero_copy_only=True),
+            array.offsets.to_numpy(zero_copy_only=True),
+        )
+
+    return array.to_numpy(zero_copy_only=True), None
+
+
+class ArrowTensorDataset(Dataset):
+    def __init__(self, dataset, pad_values):
+        self.dataset = dataset
+        self.pad_values = pad_values
+        self.load_arrays()
+
+    def load_arrays(self):
+        self.columns = {
+            name: column_arrays(self.dataset.data.column(name))
+            for name in self.dataset.column_names
+        }
+
+        if self.dataset._indices is None:
+            self.rows = None
+        else:
+            self.rows = self.dataset._indices.column(0).to_numpy()
+
+    def __getstate__(self):
+        # Workers started by spawning re-map the dataset files instead of
+        # receiving copies of the arrays
+        return {"dataset": self.dataset, "pad_values": self.pad_values}
+
+    def __setstate__(self, state):
+        self.__init__(state["dataset"], state["pad_values"])
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getitem__(self, index):
+        return {name: values[0] for name, values in self.__getitems__([index]).items()}
+
+    def __getitems__(self, indices):
+        indices = np.asarray(indices, dtype=np.int64)
+
+        if self.rows is not None:
+            indices = self.rows[indices]
+
+        is_range = len(indices) > 0 and np.all(np.diff(indices) == 1)
+
+        return {
+            name: torch.from_numpy(
+                self.gather(name, values, offsets, indices, is_range)
+            )
+            for name, (values, offsets) in self.columns.items()
+        }
+
+    def gather(self, name, values, offsets, indices, is_range):
+        if offsets is None:
+            if is_range:
+                return values[indices[0] : indices[-1] + 1].astype(np.int64)
+
+            return values[indices].astype(np.int64)
+
+        starts = offsets[indices]
+        lengths = offsets[indices + 1] - starts
+        max_length = int(lengths.max()) if len(lengths) else 0
+
+        # A contiguous run of rows of equal length is a single slice of the
+        # values buffer
+        if is_range and np.all(lengths == max_length):
+            return (
+                values[starts[0] : starts[0] + len(indices) * max_length]
+                .reshape(len(indices), max_length)
+                .astype(np.int64)
+            )
+
+        positions = np.arange(max_length)
+        mask = positions < lengths[:, None]
+
+        batch = np.full(
+            (len(indices), max_length), self.pad_values.get(name, 0), dtype=np.int64
+        )
+        batch[mask] = values[(starts[:, None] + positions)[mask]]
+
+        return batch
+
+
+def collate_batch(batch):
+    # Batches are already assembled by ArrowTensorDataset.__getitems__
+    return batch
+
+
+def tensor_dataloader(dataset, pad_values, num_workers, **kwargs):
+    worker_options = {}
+
+    if num_workers > 0:
+        worker_options = {"persistent_workers": True, "prefetch_factor": 4}
+
+    return DataLoader(
+        ArrowTensorDataset(dataset, pad_values),
+        collate_fn=collate_batch,
+        num_workers=num_workers,
+        pin_memory=torch.cuda.is_available(),
+        **worker_options,
+        **kwargs,
+    )
@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+"""Persistent Tokenization Cache
+
+Tokenizes a DatasetDict once with the fast tokenizer and keeps the result on
+disk, fingerprinted by the datasets, the tokenizer and its added marker tokens,
+the maximum length and the padding. Any later job with the same inputs, such as
+the weighted run next to an unweighted one, loads the tokenized datasets instead
+of tokenizing them again. The token lengths of every split are kept in a
+manifest next to them and reported on every load. Runs sharing a process, such
+as the runs of a sweep, keep the loaded datasets in memory.
+"""
+
+import hashlib
+import json
+import os
+import shutil
+
+from datasets import load_from_disk
+
+from shared.manifest import (
+    load_manifest,
+    report_manifest,
+    save_manifest,
+    tokenized_manifest,
+)
+
+TOKENIZATION_CACHE_VERSION = 3
+
+_LOADED_DATASETS = {}
+
+
+def hash_tokenizer(tokenizer):
+    if tokenizer.is_fast:
+        contents = tokenizer.backend_tokenizer.to_str()
+    else:
+        contents = json.dumps(tokenizer.get_vocab(), sort_keys=True)
+
+    return hashlib.sha256(contents.encode("utf-8")).hexdigest()
+
+
+def tokenization_key(name, datasets, tokenizer, max_length, padding):
+    key_contents = [
+        TOKENIZATION_CACHE_VERSION,
+        name,
+        {split: datasets[split]._fingerprint for split in datasets},
+        tokenizer.name_or_path,
+        hash_tokenizer(tokenizer),
+        sorted(tokenizer.get_added_vocab().items()),
+        max_length,
+        padding,
+    ]
+
+    return hashlib.sha256(json.dumps(key_contents).encode("utf-8")).hexdigest()
+
+
+def load_tokenized_datasets(cache_dir):
+    if cache_dir not in _LOADED_DATASETS:
+        report_manifest(load_manifest(cache_dir))
+        _LOADED_DATASETS[cache_dir] = load_from_disk(cache_dir)
+
+    return _LOADED_DATASETS[cache_dir]
+
+
+def tokenize_datasets(
+    cache_root,
+    name,
+    datasets,
+    tokenizer,
+    tokenize_function,
+    max_length,
+    padding,
+    **kwargs,
+):
+    cache_dir = (
+        cache_root
+        + name
+        + "-"
+        + tokenization_key(name, datasets, tokenizer, max_length, padding)
+    )
+
+    if os.path.exists(cache_dir):
+        print("Loading Tokenized Datasets from " + cache_dir)
+        return load_tokenized_datasets(cache_dir)
+
+    temp_dir = cache_dir + "." + str(os.getpid()) + ".tmp"
+    shutil.rmtree(temp_dir, ignore_errors=True)
+    os.makedirs(temp_dir)
+
+    # Keep the intermediate map output out of the source dataset directories
+    tokenized_datasets = datasets.map(
+        tokenize_function,
+        batched=True,
+        cache_file_names={
+            split: os.path.join(temp_dir, "map-" + split + ".arrow")
+            for split in datasets
+        },
+        **kwargs,
+    )
+    tokenized_datasets.save_to_disk(os.path.join(temp_dir, "tokenized"))
+    save_manifest(
+        os.path.join(temp_dir, "tokenized"),
+        tokenized_manifest(tokenized_datasets, max_length),
+    )
+
+    try:
+        os.rename(os.path.join(temp_dir, "tokenized"), cache_dir)
+    except OSError:
+        # Another job saved the same tokenized datasets in the meantime
+        pass
+
+    shutil.rmtree(temp_dir, ignore_errors=True)
+
+    return load_tokenized_datasets(cache_dir)